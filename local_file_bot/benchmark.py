@@ -0,0 +1,547 @@
+import os
+import sys
+import argparse
+import asyncio
+import datetime
+import itertools
+import json
+import logging
+import math
+import platform
+import random
+import shutil
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # Not available on Windows - peak memory is reported as unknown
+    resource = None
+
+# Drives the real handlers in local_file_bot.py with stand-in Telegram
+# objects against a throwaway catalog, and reports latency percentiles,
+# throughput, SQLite statement counts and peak memory.
+#
+#   python benchmark.py                                  # 10k files, 1k users
+#   python benchmark.py --files 1000000 --users 100000 --concurrency 64
+#   python benchmark.py --save baseline.json             # record a baseline
+#   python benchmark.py --compare baseline.json          # fail on regressions
+#
+# Set BOT_TOKEN and ADMIN_ID in local_file_bot.py first - the bot module is
+# imported as is. Nothing talks to Telegram.
+
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# scenario -> weight in the generated update mix
+SCENARIOS = {
+    "start": 10,
+    "main_menu": 10,
+    "browse_files": 15,
+    "browse_next": 10,
+    "get": 25,
+    "search": 15,
+    "search_page": 5,
+    "admin_stats": 3,
+    "manage_users": 3,
+    "pending_users": 2,
+    "add": 2,
+}
+
+NAME_WORDS = ["holiday", "meeting", "notes", "album", "track", "report", "invoice", "photo", "video",
+              "lecture", "backup", "draft", "summary", "budget", "music", "scan", "slides", "recording"]
+NAME_EXTENSIONS = [".pdf", ".jpg", ".mp3", ".mp4", ".zip", ".docx", ".png", ".txt"]
+SEED_CHUNK = 10000  # Rows per executemany when building the catalog
+
+
+# ========== FAKE TELEGRAM OBJECTS ==========
+class FakeUser:
+    def __init__(self, user_id):
+        self.id = user_id
+        self.first_name = f"User{user_id}"
+        self.username = f"user{user_id}"
+
+
+class FakeChat:
+    def __init__(self, chat_id):
+        self.id = chat_id
+
+
+class FakeAttachment:
+    def __init__(self, file_id, file_name=None):
+        self.file_id = file_id
+        self.file_name = file_name
+
+
+class FakeFile:
+    """What Bot.get_file returns - a local path, as from a local Bot API server"""
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+
+
+class FakeApi:
+    """Counts outgoing calls and simulates Telegram's round trip"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.bytes_sent = 0
+
+    async def call(self, payload=None):
+        self.calls += 1
+        if isinstance(payload, (bytes, bytearray)):
+            self.bytes_sent += len(payload)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class FakeBot:
+    def __init__(self, api, upload_source):
+        self.api = api
+        self.upload_source = upload_source
+
+    async def get_file(self, file_id):
+        await self.api.call()
+        return FakeFile(self.upload_source)
+
+
+class FakeMessage:
+    _message_ids = itertools.count(1)
+
+    def __init__(self, api, chat_id, text=None, reply_to_message=None):
+        self.api = api
+        self.message_id = next(self._message_ids)
+        self.chat_id = chat_id
+        self.text = text
+        self.reply_to_message = reply_to_message
+        self.document = self.photo = self.video = self.audio = self.voice = None
+        self.effective_attachment = None
+
+    async def reply_text(self, text, **kwargs):
+        await self.api.call()
+        return FakeMessage(self.api, self.chat_id, text)
+
+    async def edit_text(self, text, **kwargs):
+        await self.api.call()
+
+    async def _reply_media(self, media):
+        await self.api.call(media)
+        sent = FakeMessage(self.api, self.chat_id)
+        sent.effective_attachment = FakeAttachment(f"sent_{sent.message_id}")
+        return sent
+
+    async def reply_photo(self, photo, **kwargs):
+        return await self._reply_media(photo)
+
+    async def reply_audio(self, audio, **kwargs):
+        return await self._reply_media(audio)
+
+    async def reply_video(self, video, **kwargs):
+        return await self._reply_media(video)
+
+    async def reply_document(self, document, **kwargs):
+        return await self._reply_media(document)
+
+
+class FakeCallbackQuery:
+    def __init__(self, api, user, data):
+        self.api = api
+        self.from_user = user
+        self.data = data
+        self.message = FakeMessage(api, user.id)
+
+    async def answer(self, text=None, show_alert=False):
+        await self.api.call()
+
+    async def edit_message_text(self, text, **kwargs):
+        await self.api.call()
+
+
+class FakeUpdate:
+    def __init__(self, user, message=None, callback_query=None):
+        self.effective_user = user
+        self.effective_chat = FakeChat(user.id)
+        self.message = message
+        self.callback_query = callback_query
+
+
+class FakeContext:
+    def __init__(self, bot, user_data, args=None):
+        self.bot = bot
+        self.user_data = user_data
+        self.args = args or []
+
+
+# ========== QUERY COUNTING ==========
+class QueryCounter:
+    """Counts SQL statements on every connection handed out by get_db()
+
+    Statements run inside SQLite on the bot's behalf (triggers, FTS5 index
+    reads) are traced with a "-- " prefix and counted separately.
+    """
+
+    def __init__(self, lfb):
+        self.count = 0
+        self.nested = 0
+        self._lock = threading.Lock()
+        self._traced = set()
+        self._get_db = lfb.get_db
+        lfb.get_db = self.get_db
+
+    def _trace(self, statement):
+        with self._lock:
+            if statement.startswith("-- "):
+                self.nested += 1
+            else:
+                self.count += 1
+
+    def get_db(self):
+        conn = self._get_db()
+        if id(conn) not in self._traced:
+            conn.set_trace_callback(self._trace)
+            self._traced.add(id(conn))
+        return conn
+
+
+# ========== CATALOG ==========
+def seed_catalog(lfb, files, users, filepath, rng):
+    """Fill the catalog with files rows (all backed by filepath) and users rows"""
+    conn = lfb.get_db()
+    size = os.path.getsize(filepath)
+
+    def file_rows(start, stop):
+        for i in range(start, stop):
+            name = f"{rng.choice(NAME_WORDS)} {rng.choice(NAME_WORDS)} {i}{rng.choice(NAME_EXTENSIONS)}"
+            # Half the files have been sent before and can be resent by reference
+            telegram_file_id = f"seeded_{i}" if i % 2 else None
+            yield lfb.encode_file_id(i), name, name, filepath, size, lfb.ADMIN_ID, telegram_file_id
+
+    for start in range(1, files + 1, SEED_CHUNK):
+        with conn:
+            conn.executemany(
+                'INSERT INTO files (file_id, display_name, original_name, filepath, file_size, uploaded_by, '
+                'telegram_file_id) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                file_rows(start, min(start + SEED_CHUNK, files + 1)))
+
+    for start in range(0, users, SEED_CHUNK):
+        with conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO users (user_id, username, first_name, is_allowed) VALUES (?, ?, ?, ?)',
+                ((user_id, f"user{user_id}", f"User{user_id}", int(user_id % 4 != 0))
+                 for user_id in range(1000000 + start, 1000000 + min(start + SEED_CHUNK, users))))
+
+    lfb.seed_file_id_sequence()
+    lfb.bump_data_version("files", "users")
+    return [user_id for user_id in range(1000000, 1000000 + users) if user_id % 4 != 0]
+
+
+# ========== WORKLOAD ==========
+class Workload:
+    """Builds and runs one update for each scenario against the real handlers"""
+
+    def __init__(self, lfb, api, bot, approved_users, files, rng):
+        self.lfb = lfb
+        self.api = api
+        self.bot = bot
+        self.approved_users = approved_users or [lfb.ADMIN_ID]
+        self.files = files
+        self.rng = rng
+        self.user_data = {}
+        # The bot processes one update at a time per chat, so admin updates are serialized
+        self.admin_lock = asyncio.Lock()
+        self.next_page = "browse_files"
+
+    def context(self, user_id, args=None):
+        return FakeContext(self.bot, self.user_data.setdefault(user_id, {}), args)
+
+    def pick_user(self):
+        return FakeUser(self.rng.choice(self.approved_users))
+
+    async def command(self, handler, user, text, args=None):
+        message = FakeMessage(self.api, user.id, text)
+        await handler(FakeUpdate(user, message=message), self.context(user.id, args))
+
+    async def callback(self, user, data):
+        query = FakeCallbackQuery(self.api, user, data)
+        await self.lfb.handle_callback(FakeUpdate(user, callback_query=query), self.context(user.id))
+
+    async def prepare(self):
+        """Find a second Browse Files page to tap on"""
+        _, keyboard = await self.lfb.render_screen(
+            "browse_files", "", ("files",), self.lfb.render_browse_files, "")
+        for row in keyboard.inline_keyboard:
+            for button in row:
+                if button.callback_data.startswith("browse_files:n:"):
+                    self.next_page = button.callback_data
+
+    async def run(self, scenario):
+        lfb = self.lfb
+        if scenario == "start":
+            await self.command(lfb.start, self.pick_user(), "/start")
+        elif scenario in ("main_menu", "browse_files"):
+            await self.callback(self.pick_user(), scenario)
+        elif scenario == "browse_next":
+            await self.callback(self.pick_user(), self.next_page)
+        elif scenario == "get":
+            file_id = lfb.encode_file_id(self.rng.randint(1, max(1, self.files)))
+            await self.command(lfb.get_file_cmd, self.pick_user(), f"/get {file_id}", [file_id])
+        elif scenario == "search":
+            word = self.rng.choice(NAME_WORDS)
+            await self.command(lfb.search_files_cmd, self.pick_user(), f"/search {word}", [word])
+        elif scenario == "search_page":
+            user = self.pick_user()
+            self.context(user.id).user_data["search_query"] = self.rng.choice(NAME_WORDS)
+            await self.callback(user, f"search_page:{lfb.SEARCH_PAGE_SIZE}")
+        elif scenario in ("admin_stats", "manage_users", "pending_users"):
+            async with self.admin_lock:
+                await self.callback(FakeUser(lfb.ADMIN_ID), scenario)
+        elif scenario == "add":
+            admin = FakeUser(lfb.ADMIN_ID)
+            upload = FakeMessage(self.api, admin.id)
+            upload.document = FakeAttachment(f"upload_{upload.message_id}", f"upload {upload.message_id}.bin")
+            async with self.admin_lock:
+                # /add sent as a reply to the uploaded document, then "Keep Original"
+                message = FakeMessage(self.api, admin.id, "/add", reply_to_message=upload)
+                await lfb.add_file_cmd(FakeUpdate(admin, message=message), self.context(admin.id))
+                before = set(lfb._background_tasks)
+                await self.callback(admin, "keep_original")
+                # The save runs as a background task - count it, since that is where the upload's time goes
+                await asyncio.gather(*(set(lfb._background_tasks) - before))
+        else:
+            raise ValueError(f"Unknown scenario: {scenario}")
+
+
+async def run_updates(workload, scenarios, concurrency):
+    """Run scenarios with at most concurrency in flight, returning per-scenario latencies"""
+    latencies = {}
+    slots = asyncio.Semaphore(concurrency)
+
+    async def run_one(scenario):
+        async with slots:
+            started = time.perf_counter()
+            await workload.run(scenario)
+            latencies.setdefault(scenario, []).append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(run_one(scenario) for scenario in scenarios))
+    return latencies, time.perf_counter() - started
+
+
+# ========== REPORTING ==========
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, math.ceil(fraction * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+
+def summarize(latencies):
+    """Count and p50/p95/p99 in milliseconds"""
+    values = sorted(latencies)
+    return {
+        "count": len(values),
+        "p50_ms": round(percentile(values, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(values, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+    }
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process, or None where it cannot be read"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def print_report(result):
+    overall = result["overall"]
+    print("=" * 72)
+    print(f"📊 {overall['count']} updates in {result['elapsed_seconds']:.2f}s - "
+          f"{overall['updates_per_sec']:.1f} updates/s")
+    print(f"   p50 {overall['p50_ms']:.2f}ms   p95 {overall['p95_ms']:.2f}ms   p99 {overall['p99_ms']:.2f}ms")
+    print(f"   {result['db_queries']} SQL statements ({result['queries_per_update']:.2f} per update, "
+          f"plus {result['db_nested_statements']} run by triggers/FTS5), "
+          f"{result['api_calls']} API calls, peak RSS {result['peak_rss_mb']} MB")
+    print("-" * 72)
+    print(f"{'scenario':<16}{'count':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'SQL/update':>14}")
+    for name, stats in result["scenarios"].items():
+        print(f"{name:<16}{stats['count']:>8}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}"
+              f"{stats['p99_ms']:>10.2f}{stats.get('queries_per_update', 0):>14.2f}")
+    print("=" * 72)
+
+
+def compare(result, baseline, tolerance):
+    """Print changes against a saved baseline and return the regressions found"""
+    if baseline.get("config") != result["config"]:
+        print("⚠️  Baseline was recorded with a different configuration - numbers may not be comparable")
+
+    regressions = []
+
+    def check(label, current, previous, higher_is_worse=True):
+        if not previous:
+            return
+        change = (current - previous) / previous
+        worse = change > tolerance if higher_is_worse else change < -tolerance
+        marker = "❌" if worse else "  "
+        print(f"{marker} {label:<32}{previous:>12.2f} -> {current:>10.2f} ({change:+.1%})")
+        if worse:
+            regressions.append(label)
+
+    print(f"Compared with baseline from {baseline.get('created', 'unknown')}:")
+    check("updates/sec", result["overall"]["updates_per_sec"], baseline["overall"]["updates_per_sec"],
+          higher_is_worse=False)
+    for key in ("p50_ms", "p95_ms", "p99_ms"):
+        check(f"overall {key}", result["overall"][key], baseline["overall"][key])
+    check("SQL statements per update", result["queries_per_update"], baseline["queries_per_update"])
+    for name, stats in result["scenarios"].items():
+        previous = baseline["scenarios"].get(name)
+        if previous:
+            check(f"{name} p95_ms", stats["p95_ms"], previous["p95_ms"])
+            check(f"{name} SQL/update", stats.get("queries_per_update", 0), previous.get("queries_per_update", 0))
+    return regressions
+
+
+# ========== MAIN ==========
+async def benchmark(lfb, args, workdir):
+    rng = random.Random(args.seed)
+    counter = QueryCounter(lfb)
+    api = FakeApi(args.api_latency / 1000)
+
+    upload_source = os.path.join(workdir, "upload_source.bin")
+    with open(upload_source, "wb") as f:
+        f.write(os.urandom(args.file_size))
+
+    print(f"🗂️  Building catalog: {args.files} files, {args.users} users...")
+    started = time.perf_counter()
+    approved_users = await lfb.run_storage(seed_catalog, lfb, args.files, args.users, upload_source, rng)
+    seed_seconds = time.perf_counter() - started
+
+    bot = FakeBot(api, upload_source)
+    workload = Workload(lfb, api, bot, approved_users, args.files, rng)
+    await workload.prepare()
+
+    names = list(SCENARIOS)
+    weights = [SCENARIOS[name] for name in names]
+
+    # Statement counts per scenario, measured one update at a time
+    per_scenario_queries = {}
+    for name in names:
+        before = counter.count
+        for _ in range(args.probe):
+            await workload.run(name)
+        per_scenario_queries[name] = (counter.count - before) / args.probe
+
+    if args.warmup:
+        print(f"🔥 Warming up with {args.warmup} updates...")
+        await run_updates(workload, rng.choices(names, weights, k=args.warmup), args.concurrency)
+
+    print(f"🚀 Running {args.updates} updates at concurrency {args.concurrency}...")
+    queries_before = counter.count
+    nested_before = counter.nested
+    api_calls_before = api.calls
+    latencies, elapsed = await run_updates(workload, rng.choices(names, weights, k=args.updates),
+                                           args.concurrency)
+    queries = counter.count - queries_before
+
+    overall = summarize([value for values in latencies.values() for value in values])
+    overall["updates_per_sec"] = round(args.updates / elapsed, 1) if elapsed else 0.0
+    scenarios = {}
+    for name in names:
+        if name in latencies:
+            scenarios[name] = summarize(latencies[name])
+            scenarios[name]["queries_per_update"] = round(per_scenario_queries[name], 2)
+
+    return {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": {
+            "files": args.files,
+            "users": args.users,
+            "updates": args.updates,
+            "concurrency": args.concurrency,
+            "api_latency_ms": args.api_latency,
+            "file_size": args.file_size,
+            "seed": args.seed,
+        },
+        "seed_seconds": round(seed_seconds, 2),
+        "elapsed_seconds": round(elapsed, 3),
+        "overall": overall,
+        "scenarios": scenarios,
+        "db_queries": queries,
+        "db_nested_statements": counter.nested - nested_before,
+        "queries_per_update": round(queries / args.updates, 2) if args.updates else 0.0,
+        "api_calls": api.calls - api_calls_before,
+        "api_bytes_sent": api.bytes_sent,
+        "peak_rss_mb": peak_rss_mb(),
+        "render_cache_hit_rate": round(lfb.cache_hit_rate(lfb.render_cache_stats), 3),
+        "approval_cache_hit_rate": round(lfb.cache_hit_rate(lfb.approval_cache_stats), 3),
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the file bot's handlers against a throwaway catalog")
+    parser.add_argument("--files", type=int, default=10000, help="files in the catalog (10 to 1000000)")
+    parser.add_argument("--users", type=int, default=1000, help="users in the catalog (10 to 100000)")
+    parser.add_argument("--updates", type=int, default=5000, help="updates to measure")
+    parser.add_argument("--warmup", type=int, default=500, help="updates run before measuring")
+    parser.add_argument("--probe", type=int, default=20, help="updates per scenario used to count SQL statements")
+    parser.add_argument("--concurrency", type=int, default=16, help="updates in flight at once")
+    parser.add_argument("--api-latency", type=float, default=0.0, help="simulated Telegram round trip in ms")
+    parser.add_argument("--file-size", type=int, default=256 * 1024, help="bytes per file sent or uploaded")
+    parser.add_argument("--seed", type=int, default=1, help="random seed for the catalog and update mix")
+    parser.add_argument("--save", metavar="JSON", help="write the results to this file as a new baseline")
+    parser.add_argument("--compare", metavar="JSON", help="compare with a saved baseline, exit 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed change before a regression (0.2 = 20%%)")
+    parser.add_argument("--keep", action="store_true", help="keep the temporary catalog directory")
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    save_path = os.path.abspath(args.save) if args.save else None
+    compare_path = os.path.abspath(args.compare) if args.compare else None
+
+    # The bot keeps its database and files relative to the working directory
+    workdir = tempfile.mkdtemp(prefix="file_bot_bench_")
+    os.chdir(workdir)
+    sys.path.insert(0, BOT_DIR)
+    import local_file_bot as lfb
+
+    logging.getLogger().setLevel(logging.WARNING)
+    lfb.init_database()
+
+    try:
+        result = asyncio.run(benchmark(lfb, args, workdir))
+    finally:
+        lfb.shutdown_storage()
+        lfb.close_database()
+        os.chdir(BOT_DIR)
+        if args.keep:
+            print(f"📂 Catalog kept in {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    print_report(result)
+
+    regressions = []
+    if compare_path:
+        with open(compare_path, encoding="utf-8") as f:
+            regressions = compare(result, json.load(f), args.tolerance)
+
+    if save_path:
+        with open(save_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+        print(f"💾 Baseline saved to {save_path}")
+
+    if regressions:
+        print(f"❌ {len(regressions)} regression(s): {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,21 +1,124 @@
 import os
+import asyncio
+import bisect
+import contextvars
+import cProfile
+import functools
+import hashlib
+import io
+import json
 import logging
 import datetime
+import multiprocessing
+import pstats
 import sqlite3
-import random
+import re
+import secrets
+import shutil
 import string
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
+import httpx
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, filters
+from telegram.error import BadRequest, RetryAfter
+from telegram.ext import (Application, BaseRateLimiter, BaseUpdateProcessor, CommandHandler, ContextTypes,
+                          CallbackQueryHandler, MessageHandler, filters)
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # pip install watchdog - FILES_DIR is polled without it
+    FileSystemEventHandler = object
+    Observer = None
+
+try:
+    import mutagen
+except ImportError:  # pip install mutagen - audio durations, tags and cover art
+    mutagen = None
+
+try:
+    from PIL import Image
+except ImportError:  # pip install Pillow - thumbnails from audio cover art
+    Image = None
+
+FFPROBE = shutil.which("ffprobe")  # Video duration and size (install ffmpeg)
+FFMPEG = shutil.which("ffmpeg")  # Video thumbnails
 
 # ========== CONFIGURATION ==========
 BOT_TOKEN = "your token here"
 ADMIN_ID = your telgram id
 FILES_DIR = "TelegramFiles"
+BLOBS_DIR = os.path.join(FILES_DIR, ".blobs")  # Uploads stored by content hash
 DB_FILE = "file_bot.db"
+DB_SYNCHRONOUS = "NORMAL"  # OFF, NORMAL, FULL or EXTRA (NORMAL is safe with WAL)
+DB_CACHED_STATEMENTS = 256  # Prepared statements kept per connection
+DB_BUSY_TIMEOUT = 30  # Seconds to wait for a locked database
+STORAGE_WORKERS = 4  # Threads doing blocking database and disk work
+STORAGE_MAX_PENDING = 64  # Storage jobs in flight before callers have to wait
+APPROVAL_CACHE_SIZE = 4096  # Users whose approval status is kept in memory
+APPROVAL_CACHE_TTL = 300  # Seconds before a cached approval is re-read from the database
+RENDER_CACHE_SIZE = 256  # Rendered list screens kept in memory
+BROWSE_PAGE_SIZE = 10  # Files per page in Browse Files
+ADMIN_FILES_PAGE_SIZE = 15  # Files per page in the admin file list
+USERS_PAGE_SIZE = 20  # Users per page in All Users and Pending Users (fewer if they would not fit)
+MESSAGE_CHAR_LIMIT = 4096  # Telegram's limit on message text, in UTF-16 code units
+SEARCH_PAGE_SIZE = 10  # Results per page in /search
+DOWNLOAD_FLUSH_INTERVAL = 30  # Seconds between writes of batched download counts
+INGEST_CHUNK_SIZE = 1024 * 1024  # Bytes per chunk when saving uploads to disk
+MAX_CONCURRENT_INGESTS = 2  # Uploads saved to disk at the same time
+INGEST_PROGRESS_INTERVAL = 2  # Seconds between progress message edits
+UPLOAD_SESSION_BACKEND = "sqlite"  # "sqlite" survives restarts, "memory" does not
+UPLOAD_SESSION_TTL = 3600  # Seconds an unfinished /add waits for Rename/Keep before it is dropped
+UPLOAD_SESSION_SWEEP_INTERVAL = 300  # Seconds between sweeps of expired upload sessions
+UPLOAD_SESSION_MAX = 1000  # Sessions kept by the memory backend before the oldest is dropped
+IMPORT_BATCH_SIZE = 500  # Files stat'ed and inserted per transaction by /import
+WATCH_FILES = True  # Keep the catalog in sync with files added, moved or deleted in FILES_DIR
+WATCH_DEBOUNCE = 1.0  # Seconds without new file events before a burst is applied
+WATCH_MAX_DELAY = 10  # Seconds a busy burst may be held back before it is applied anyway
+WATCH_POLL_INTERVAL = 30  # Seconds between scans when watchdog is not installed
+METRICS_PORT = 0  # Serve Prometheus metrics on http://METRICS_LISTEN:METRICS_PORT/metrics (0 = off)
+METRICS_LISTEN = "127.0.0.1"  # Keep metrics local unless a scraper needs to reach them
+TRACE_UPDATES = False  # Time database, disk and Telegram calls per update and log slow ones
+TRACE_SLOW_SECONDS = 1.0  # Updates slower than this are logged with their breakdown
+PROFILE_SECONDS = 10  # Default /profile capture window
+PROFILE_MAX_SECONDS = 60  # Longest capture /profile allows
+PROFILE_TOP = 30  # Functions listed in the /profile summary
+MEDIA_METADATA = True  # Extract duration, size, tags and thumbnails of audio and video files
+MEDIA_WORKERS = 2  # Processes extracting media metadata
+MEDIA_BATCH_SIZE = 50  # Files picked up per metadata pass
+MEDIA_SCAN_INTERVAL = 60  # Seconds between looks for files that still need metadata
+MEDIA_TOOL_TIMEOUT = 60  # Seconds ffprobe/ffmpeg may take on one file
+THUMBNAIL_SIZE = 320  # Telegram accepts thumbnails up to 320x320...
+THUMBNAIL_MAX_BYTES = 200 * 1024  # ...and 200 kB
+
+# ========== UPDATE DELIVERY ==========
+BOT_MODE = "polling"  # "polling", or "webhook" (needs: pip install "python-telegram-bot[webhooks]")
+WEBHOOK_LISTEN = "127.0.0.1"  # Address the embedded webhook server binds to
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "telegram"  # URL path the webhook server answers on
+WEBHOOK_URL = ""  # Public HTTPS URL Telegram posts to, e.g. https://bot.example.com/telegram
+WEBHOOK_SECRET = ""  # Secret token Telegram must send back (random per start if empty)
+UPDATE_CONCURRENCY = 16  # Updates processed at the same time (always one at a time per chat)
+UPDATE_BACKLOG = 1024  # Updates accepted at once, running or queued behind earlier ones from their chat
+OUTBOUND_GLOBAL_RATE = 30  # Messages per second across all chats (Telegram allows about 30)
+OUTBOUND_CHAT_RATE = 1  # Messages per second to one chat
+OUTBOUND_CHAT_BURST = 5  # Messages a single chat may receive back to back
+OUTBOUND_GROUP_RATE = 20 / 60  # Messages per second to one group (Telegram allows 20 a minute)
+OUTBOUND_MAX_RETRIES = 3  # Times a request is retried after a 429 flood-wait
+TELEGRAM_API_URL = "https://api.telegram.org/bot"  # Point both URLs at a fake server for local testing
+TELEGRAM_FILE_URL = "https://api.telegram.org/file/bot"
 
 # ========== SETUP ==========
 Path(FILES_DIR).mkdir(exist_ok=True)
+Path(BLOBS_DIR).mkdir(exist_ok=True)
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -23,10 +126,6 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# Store temporary data for file renaming
-user_rename_context = {}
-
-
 # ========== GLASS-STYLE BUTTONS ==========
 def create_glass_button(text, callback_data, emoji=""):
     """Create glass-style button"""
@@ -90,6 +189,27 @@ def create_back_keyboard(back_to="main_menu"):
     ]])
 
 
+def create_page_keyboard(screen, position, page_size, rows, has_prev, has_next, back_to="main_menu"):
+    """Create prev/next keyboard for a keyset-paginated list
+
+    Page buttons carry "<screen>:<n|p>:<position>:<cursor>" where the
+    cursor is the last (next) or first (prev) row of the current page.
+    """
+    nav = []
+    if has_prev:
+        first = rows[0]
+        nav.append(create_glass_button(
+            "Prev", f"{screen}:p:{max(1, position - page_size)}:{first[4]}|{first[0]}", "◀️"))
+    if has_next:
+        last = rows[-1]
+        nav.append(create_glass_button(
+            "Next", f"{screen}:n:{position + len(rows)}:{last[4]}|{last[0]}", "▶️"))
+
+    keyboard = [nav] if nav else []
+    keyboard.append([create_glass_button("Back", back_to, "🔙")])
+    return InlineKeyboardMarkup(keyboard)
+
+
 def create_rename_keyboard():
     """Create beautiful rename keyboard"""
     keyboard = [
@@ -104,13 +224,177 @@ def create_rename_keyboard():
     return InlineKeyboardMarkup(keyboard)
 
 
-# ========== DATABASE FUNCTIONS ==========
-def init_database():
-    """Initialize database"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
+# ========== DATABASE CONNECTION ==========
+_db_local = threading.local()
+_db_connections = []
+_db_connections_lock = threading.Lock()
+
 
-    cursor.execute('''
+def get_db():
+    """Get the long-lived database connection for the current thread"""
+    conn = getattr(_db_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(
+            DB_FILE,
+            timeout=DB_BUSY_TIMEOUT,
+            cached_statements=DB_CACHED_STATEMENTS,
+            check_same_thread=False
+        )
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute(f'PRAGMA synchronous = {DB_SYNCHRONOUS}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        _db_local.conn = conn
+        with _db_connections_lock:
+            _db_connections.append(conn)
+    return conn
+
+
+def close_database():
+    """Close every pooled database connection"""
+    with _db_connections_lock:
+        connections = list(_db_connections)
+        _db_connections.clear()
+    for conn in connections:
+        try:
+            conn.close()
+        except sqlite3.Error as e:
+            logger.warning(f"Failed to close database connection: {e}")
+    _db_local.conn = None
+
+
+# ========== APPROVAL CACHE ==========
+# Lookups fill the cache from the database; writes store the new status
+# directly. _approval_generation counts writes, so a lookup that read the
+# database before a write committed can't cache the old status after it.
+_approval_cache = OrderedDict()
+_approval_cache_lock = threading.Lock()
+_approval_generation = 0
+
+# Counters for the approval cache
+approval_cache_stats = {
+    "hits": 0,
+    "misses": 0,
+    "writes": 0,
+    "stale_fills": 0
+}
+
+
+def get_cached_approval(user_id):
+    """Get cached approval status, or None if it is unknown or expired"""
+    with _approval_cache_lock:
+        entry = _approval_cache.get(user_id)
+        if entry is None or entry[1] < time.monotonic():
+            if entry is not None:
+                del _approval_cache[user_id]
+            approval_cache_stats["misses"] += 1
+            return None
+        _approval_cache.move_to_end(user_id)
+        approval_cache_stats["hits"] += 1
+        return entry[0]
+
+
+def get_approval_generation():
+    """Get the write count to pass to cache_approval() - take it before reading the database"""
+    with _approval_cache_lock:
+        return _approval_generation
+
+
+def _store_approval(user_id, approved):
+    _approval_cache[user_id] = (approved, time.monotonic() + APPROVAL_CACHE_TTL)
+    _approval_cache.move_to_end(user_id)
+    while len(_approval_cache) > APPROVAL_CACHE_SIZE:
+        _approval_cache.popitem(last=False)
+
+
+def cache_approval(user_id, approved, generation):
+    """Remember approval status read from the database, unless a write happened since generation"""
+    with _approval_cache_lock:
+        if generation != _approval_generation:
+            # The status may have changed after it was read - leave it to the next lookup
+            approval_cache_stats["stale_fills"] += 1
+            return
+        _store_approval(user_id, approved)
+
+
+def write_approval(user_id, approved):
+    """Cache a user's new approval status after changing it in the database"""
+    global _approval_generation
+    with _approval_cache_lock:
+        _approval_generation += 1
+        approval_cache_stats["writes"] += 1
+        _store_approval(user_id, approved)
+
+
+# ========== RENDER CACHE ==========
+# Rendered list screens are cached under the version of the tables they
+# show. The write helpers bump those versions, so an entry is never served
+# after its data changed - it just ages out of the LRU.
+_data_versions = {"files": 0, "users": 0, "downloads": 0}
+_render_cache = OrderedDict()
+_render_cache_lock = threading.Lock()
+
+# Counters for the render cache
+render_cache_stats = {
+    "hits": 0,
+    "misses": 0
+}
+
+
+def bump_data_version(*tables):
+    """Mark tables as changed so screens showing them are rendered again"""
+    with _render_cache_lock:
+        for table in tables:
+            _data_versions[table] += 1
+
+
+def get_data_version(*tables):
+    """Get the current versions of tables, for use in a cache key"""
+    with _render_cache_lock:
+        return tuple(_data_versions[table] for table in tables)
+
+
+def get_cached_render(key):
+    """Get a cached (message, keyboard), or None"""
+    with _render_cache_lock:
+        rendered = _render_cache.get(key)
+        if rendered is None:
+            render_cache_stats["misses"] += 1
+            return None
+        _render_cache.move_to_end(key)
+        render_cache_stats["hits"] += 1
+        return rendered
+
+
+def cache_render(key, rendered):
+    """Remember a rendered (message, keyboard)"""
+    with _render_cache_lock:
+        _render_cache[key] = rendered
+        _render_cache.move_to_end(key)
+        while len(_render_cache) > RENDER_CACHE_SIZE:
+            _render_cache.popitem(last=False)
+
+
+def cache_hit_rate(stats):
+    """Get the share of lookups answered from a cache, from its stats counters"""
+    lookups = stats["hits"] + stats["misses"]
+    return stats["hits"] / lookups if lookups else 0.0
+
+
+# ========== SCHEMA MIGRATIONS ==========
+# Each migration runs once, in order, inside its own transaction. They are
+# written to be idempotent so databases created before schema_version
+# existed upgrade cleanly. Add new schema changes as a new migration at the
+# end of MIGRATIONS - never edit one that has shipped.
+def add_column_if_missing(conn, table, column, definition):
+    """Add a column to an existing table unless it is already there"""
+    columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table})')}
+    if column not in columns:
+        conn.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+
+
+def migrate_base_tables(conn):
+    """Create users and files tables"""
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
             username TEXT,
@@ -120,7 +404,7 @@ def init_database():
         )
     ''')
 
-    cursor.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS files (
             file_id TEXT PRIMARY KEY,
             display_name TEXT,
@@ -132,11 +416,227 @@ def init_database():
         )
     ''')
 
+
+def migrate_telegram_file_id(conn):
+    """Store the Telegram file reference returned by the first send"""
+    add_column_if_missing(conn, 'files', 'telegram_file_id', 'TEXT')
+
+
+def migrate_upload_date_index(conn):
+    """Index files newest first for keyset pagination"""
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_files_upload_date ON files (upload_date, file_id)')
+
+
+def migrate_files_fts(conn):
+    """Full-text index over file names, kept in sync by triggers"""
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS files_fts USING fts5(
+            display_name,
+            original_name,
+            content='files',
+            content_rowid='rowid',
+            prefix='2 3',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS files_fts_insert AFTER INSERT ON files BEGIN
+            INSERT INTO files_fts (rowid, display_name, original_name)
+            VALUES (new.rowid, new.display_name, new.original_name);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS files_fts_delete AFTER DELETE ON files BEGIN
+            INSERT INTO files_fts (files_fts, rowid, display_name, original_name)
+            VALUES ('delete', old.rowid, old.display_name, old.original_name);
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS files_fts_update AFTER UPDATE OF display_name, original_name ON files BEGIN
+            INSERT INTO files_fts (files_fts, rowid, display_name, original_name)
+            VALUES ('delete', old.rowid, old.display_name, old.original_name);
+            INSERT INTO files_fts (rowid, display_name, original_name)
+            VALUES (new.rowid, new.display_name, new.original_name);
+        END
+    ''')
+    # Backfill files uploaded before the index existed
+    conn.execute("INSERT INTO files_fts (files_fts) VALUES ('rebuild')")
+
+
+def migrate_stats_counters(conn):
+    """Running totals for the statistics screen, kept up to date by triggers"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS stats (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS stats_files_insert AFTER INSERT ON files BEGIN
+            UPDATE stats SET value = value + CASE name WHEN 'file_count' THEN 1 ELSE COALESCE(new.file_size, 0) END
+            WHERE name IN ('file_count', 'total_size');
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS stats_files_delete AFTER DELETE ON files BEGIN
+            UPDATE stats SET value = value - CASE name WHEN 'file_count' THEN 1 ELSE COALESCE(old.file_size, 0) END
+            WHERE name IN ('file_count', 'total_size');
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS stats_files_update AFTER UPDATE OF file_size ON files BEGIN
+            UPDATE stats SET value = value + COALESCE(new.file_size, 0) - COALESCE(old.file_size, 0)
+            WHERE name = 'total_size';
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS stats_users_insert AFTER INSERT ON users BEGIN
+            UPDATE stats SET value = value + CASE name WHEN 'user_count' THEN 1 ELSE (new.is_allowed IS 1) END
+            WHERE name IN ('user_count', 'approved_users');
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS stats_users_delete AFTER DELETE ON users BEGIN
+            UPDATE stats SET value = value - CASE name WHEN 'user_count' THEN 1 ELSE (old.is_allowed IS 1) END
+            WHERE name IN ('user_count', 'approved_users');
+        END
+    ''')
+    conn.execute('''
+        CREATE TRIGGER IF NOT EXISTS stats_users_update AFTER UPDATE OF is_allowed ON users BEGIN
+            UPDATE stats SET value = value + (new.is_allowed IS 1) - (old.is_allowed IS 1)
+            WHERE name = 'approved_users';
+        END
+    ''')
+    # Backfill from the existing rows
+    conn.execute('''
+        INSERT OR REPLACE INTO stats (name, value)
+        SELECT 'file_count', COUNT(*) FROM files
+        UNION ALL SELECT 'total_size', COALESCE(SUM(file_size), 0) FROM files
+        UNION ALL SELECT 'user_count', COUNT(*) FROM users
+        UNION ALL SELECT 'approved_users', COUNT(*) FROM users WHERE is_allowed = 1
+    ''')
+
+
+def migrate_download_counts(conn):
+    """Per-user and per-file download counters written by flush_downloads()"""
+    add_column_if_missing(conn, 'files', 'download_count', 'INTEGER NOT NULL DEFAULT 0')
+    add_column_if_missing(conn, 'users', 'download_count', 'INTEGER NOT NULL DEFAULT 0')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS downloads (
+            user_id INTEGER NOT NULL,
+            file_id TEXT NOT NULL,
+            download_count INTEGER NOT NULL DEFAULT 0,
+            last_download TIMESTAMP,
+            PRIMARY KEY (user_id, file_id)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_files_download_count ON files (download_count)')
+
+
+def migrate_user_indexes(conn):
+    """Index users for the pending and all-users lists"""
+    # Covers the pending users list entirely, so the table is never touched
+    conn.execute(
+        'CREATE INDEX IF NOT EXISTS idx_users_pending ON users (is_allowed, join_date, user_id, username, first_name)')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_users_join_date ON users (join_date, user_id)')
+
+
+def migrate_content_hash(conn):
+    """Content hash for deduplicated blob storage, reference-counted by filepath"""
+    add_column_if_missing(conn, 'files', 'content_hash', 'TEXT')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_files_filepath ON files (filepath)')
+
+
+def migrate_upload_sessions(conn):
+    """Pending /add uploads waiting for a name, used by SQLiteSessionStore"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS upload_sessions (
+            user_id INTEGER PRIMARY KEY,
+            data TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_upload_sessions_expires_at ON upload_sessions (expires_at)')
+
+
+def migrate_file_mtime(conn):
+    """Modification time of catalogued files, so /import can skip unchanged ones"""
+    add_column_if_missing(conn, 'files', 'file_mtime', 'REAL')
+
+
+def migrate_media_metadata(conn):
+    """Media duration, size, tags and thumbnail, filled in by media_metadata_loop()"""
+    add_column_if_missing(conn, 'files', 'media_duration', 'INTEGER')
+    add_column_if_missing(conn, 'files', 'media_width', 'INTEGER')
+    add_column_if_missing(conn, 'files', 'media_height', 'INTEGER')
+    add_column_if_missing(conn, 'files', 'media_performer', 'TEXT')
+    add_column_if_missing(conn, 'files', 'media_title', 'TEXT')
+    add_column_if_missing(conn, 'files', 'media_thumbnail', 'BLOB')
+    add_column_if_missing(conn, 'files', 'media_extracted', 'INTEGER NOT NULL DEFAULT 0')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_files_media_pending ON files (file_id) WHERE media_extracted = 0')
+
+
+MIGRATIONS = [
+    (1, migrate_base_tables),
+    (2, migrate_telegram_file_id),
+    (3, migrate_upload_date_index),
+    (4, migrate_files_fts),
+    (5, migrate_stats_counters),
+    (6, migrate_download_counts),
+    (7, migrate_user_indexes),
+    (8, migrate_content_hash),
+    (9, migrate_upload_sessions),
+    (10, migrate_file_mtime),
+    (11, migrate_media_metadata),
+]
+
+
+def get_schema_version(conn):
+    """Get the highest migration applied to the database"""
+    return conn.execute('SELECT COALESCE(MAX(version), 0) FROM schema_version').fetchone()[0]
+
+
+def run_migrations(conn):
+    """Apply pending migrations in order"""
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
     conn.commit()
-    cursor.execute('INSERT OR IGNORE INTO users (user_id, username, first_name, is_allowed) VALUES (?, ?, ?, 1)',
-                   (ADMIN_ID, "Admin", "Admin"))
-    conn.commit()
-    conn.close()
+
+    for version, migration in MIGRATIONS:
+        if version <= get_schema_version(conn):
+            continue
+
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Another process may have migrated while we waited for the lock
+            if version <= get_schema_version(conn):
+                conn.rollback()
+                continue
+            migration(conn)
+            conn.execute('INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                         (version, migration.__doc__))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        logger.info(f"Applied migration {version}: {migration.__doc__}")
+
+
+# ========== DATABASE FUNCTIONS ==========
+def init_database():
+    """Initialize database"""
+    conn = get_db()
+    run_migrations(conn)
+
+    with conn:
+        conn.execute('INSERT OR IGNORE INTO users (user_id, username, first_name, is_allowed) VALUES (?, ?, ?, 1)',
+                     (ADMIN_ID, "Admin", "Admin"))
+    seed_file_id_sequence()
     print("✅ Database initialized")
 
 
@@ -145,140 +645,1754 @@ def is_admin(user_id):
     return user_id == ADMIN_ID
 
 
-def is_user_approved(user_id):
-    """Check if user is approved to use the bot"""
-    if user_id == ADMIN_ID:
-        return True
-
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT is_allowed FROM users WHERE user_id = ?', (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-
-    if result is None:
-        return False
-    return result[0] == 1
+def load_user_approval(user_id):
+    """Read approval status from the database and cache it"""
+    generation = get_approval_generation()
+    result = get_db().execute('SELECT is_allowed FROM users WHERE user_id = ?', (user_id,)).fetchone()
+    approved = result is not None and result[0] == 1
+    cache_approval(user_id, approved, generation)
+    return approved
 
 
 def add_or_update_user(user_id, username, first_name, is_allowed=None):
     """Add or update user in database"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT is_allowed FROM users WHERE user_id = ?', (user_id,))
-    existing = cursor.fetchone()
-
-    if existing:
-        if is_allowed is not None:
-            cursor.execute('UPDATE users SET username = ?, first_name = ?, is_allowed = ? WHERE user_id = ?',
-                           (username, first_name, is_allowed, user_id))
+    generation = get_approval_generation()
+    conn = get_db()
+    with conn:
+        existing = conn.execute('SELECT is_allowed, username, first_name FROM users WHERE user_id = ?',
+                                (user_id,)).fetchone()
+
+        if existing:
+            if is_allowed is not None:
+                conn.execute('UPDATE users SET username = ?, first_name = ?, is_allowed = ? WHERE user_id = ?',
+                             (username, first_name, is_allowed, user_id))
+            else:
+                conn.execute('UPDATE users SET username = ?, first_name = ? WHERE user_id = ?',
+                             (username, first_name, user_id))
         else:
-            cursor.execute('UPDATE users SET username = ?, first_name = ? WHERE user_id = ?',
-                           (username, first_name, user_id))
+            if is_allowed is None:
+                is_allowed = 0
+            conn.execute('INSERT INTO users (user_id, username, first_name, is_allowed) VALUES (?, ?, ?, ?)',
+                         (user_id, username, first_name, is_allowed))
+
+    if existing is None or existing[1:] != (username, first_name) or is_allowed not in (None, existing[0]):
+        bump_data_version("users")
+    if is_allowed is None:
+        # Only read here, so cached like any other lookup
+        cache_approval(user_id, existing[0] == 1, generation)
     else:
-        if is_allowed is None:
-            is_allowed = 0
-        cursor.execute('INSERT INTO users (user_id, username, first_name, is_allowed) VALUES (?, ?, ?, ?)',
-                       (user_id, username, first_name, is_allowed))
-    conn.commit()
-    conn.close()
+        # Write-through: the new status replaces whatever was cached
+        write_approval(user_id, is_allowed == 1)
 
 
 def approve_user_in_db(user_id):
     """Approve a user in database"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('UPDATE users SET is_allowed = 1 WHERE user_id = ?', (user_id,))
-    updated = cursor.rowcount
-    conn.commit()
-    conn.close()
+    conn = get_db()
+    with conn:
+        updated = conn.execute('UPDATE users SET is_allowed = 1 WHERE user_id = ?', (user_id,)).rowcount
+    if updated:
+        write_approval(user_id, True)
+    bump_data_version("users")
     return updated > 0
 
 
-def get_pending_users():
-    """Get all pending users"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id, username, first_name, join_date FROM users WHERE is_allowed = 0 ORDER BY join_date')
-    users = cursor.fetchall()
-    conn.close()
-    return users
-
-
-def get_all_users():
-    """Get all users"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT user_id, username, first_name, is_allowed, join_date FROM users ORDER BY join_date DESC')
-    users = cursor.fetchall()
-    conn.close()
-    return users
+def get_users_page(limit, pending=False, direction=None, cursor=None):
+    """Get one page of users using a (join_date, user_id) cursor
+
+    All users are listed newest first, pending users oldest first (the order
+    they should be approved in). direction works as in get_files_page().
+    Returns (rows, has_prev, has_next).
+    """
+    conn = get_db()
+    columns = 'SELECT user_id, username, first_name, is_allowed, join_date FROM users'
+    pending_filter = 'is_allowed = 0 AND ' if pending else ''
+    forward, backward = ('', ' DESC') if pending else (' DESC', '')
+    after, before = ('>', '<') if pending else ('<', '>')
+
+    if direction == "p" and cursor is not None:
+        rows = conn.execute(
+            f'{columns} WHERE {pending_filter}(join_date, user_id) {before} (?, ?) '
+            f'ORDER BY join_date{backward}, user_id{backward} LIMIT ?',
+            (cursor[0], cursor[1], limit + 1)).fetchall()
+        has_prev = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+        return rows, has_prev, True
+
+    if direction == "n" and cursor is not None:
+        rows = conn.execute(
+            f'{columns} WHERE {pending_filter}(join_date, user_id) {after} (?, ?) '
+            f'ORDER BY join_date{forward}, user_id{forward} LIMIT ?',
+            (cursor[0], cursor[1], limit + 1)).fetchall()
+        return rows[:limit], True, len(rows) > limit
+
+    rows = conn.execute(
+        f'{columns} {"WHERE is_allowed = 0 " if pending else ""}ORDER BY join_date{forward}, user_id{forward} LIMIT ?',
+        (limit + 1,)).fetchall()
+    return rows[:limit], False, len(rows) > limit
+
+
+# File IDs are "file_" plus 8 base36 digits of milliseconds since
+# FILE_ID_EPOCH_MS (good until 2113). They sort in creation order, so new
+# rows append to the end of the primary key index. IDs from the old random
+# scheme have 6 digits and can never clash with these.
+FILE_ID_EPOCH_MS = 1704067200000  # 2024-01-01 UTC
+FILE_ID_DIGITS = 8
+FILE_ID_ALPHABET = string.digits + string.ascii_lowercase
+SAVE_FILE_ATTEMPTS = 5
+
+_file_id_lock = threading.Lock()
+_last_file_id_tick = 0
+
+
+def encode_file_id(tick):
+    """Encode a millisecond tick as a fixed-width file ID"""
+    digits = []
+    for _ in range(FILE_ID_DIGITS):
+        tick, remainder = divmod(tick, 36)
+        digits.append(FILE_ID_ALPHABET[remainder])
+    return "file_" + "".join(reversed(digits))
+
+
+def decode_file_id(file_id):
+    """Get the millisecond tick of a time-ordered file ID, or None for other IDs"""
+    suffix = file_id[5:] if file_id.startswith("file_") else ""
+    if len(suffix) != FILE_ID_DIGITS:
+        return None
+    try:
+        return int(suffix, 36)
+    except ValueError:
+        return None
 
 
 def generate_file_id():
-    """Generate simple file ID"""
-    letters = string.ascii_lowercase + string.digits
-    return f"file_{''.join(random.choices(letters, k=6))}"
-
-
-def save_file(file_id, display_name, original_name, filepath, file_size, uploaded_by):
-    """Save file to database with display name"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute(
-        'INSERT INTO files (file_id, display_name, original_name, filepath, file_size, uploaded_by) VALUES (?, ?, ?, ?, ?, ?)',
-        (file_id, display_name, original_name, filepath, file_size, uploaded_by))
-    conn.commit()
-    conn.close()
-
-
-def get_all_files():
-    """Get all files"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT file_id, display_name, original_name, file_size FROM files ORDER BY upload_date DESC')
-    files = cursor.fetchall()
-    conn.close()
-    return files
+    """Generate a short, time-ordered file ID
+
+    Two IDs in the same millisecond (or after the clock steps back) get
+    consecutive ticks, so IDs from one process are strictly increasing.
+    """
+    global _last_file_id_tick
+    with _file_id_lock:
+        tick = max(int(time.time() * 1000) - FILE_ID_EPOCH_MS, _last_file_id_tick + 1)
+        _last_file_id_tick = tick
+    return encode_file_id(tick)
+
+
+def seed_file_id_sequence():
+    """Continue the ID sequence after the newest ID already in the database"""
+    global _last_file_id_tick
+    row = get_db().execute(
+        "SELECT MAX(file_id) FROM files WHERE substr(file_id, 1, 5) = 'file_' AND length(file_id) = ?",
+        (5 + FILE_ID_DIGITS,)).fetchone()
+    tick = decode_file_id(row[0]) if row and row[0] else None
+    if tick is not None:
+        with _file_id_lock:
+            _last_file_id_tick = max(_last_file_id_tick, tick)
+
+
+def save_file(file_id, display_name, original_name, filepath, file_size, uploaded_by, content_hash=None):
+    """Save file to database with display name
+
+    Pass file_id=None to have one generated. If the ID is already taken a
+    fresh one is generated and the insert retried. Returns the ID used.
+    """
+    conn = get_db()
+    for attempt in range(SAVE_FILE_ATTEMPTS):
+        if file_id is None or attempt > 0:
+            file_id = generate_file_id()
+        try:
+            with conn:
+                conn.execute(
+                    'INSERT INTO files (file_id, display_name, original_name, filepath, file_size, uploaded_by, content_hash) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (file_id, display_name, original_name, filepath, file_size, uploaded_by, content_hash))
+            bump_data_version("files")
+            return file_id
+        except sqlite3.IntegrityError:
+            if attempt == SAVE_FILE_ATTEMPTS - 1:
+                raise
+            logger.warning(f"File ID {file_id} already taken, retrying")
+
+
+def get_files_page(limit, direction=None, cursor=None):
+    """Get one page of files, newest first, using an (upload_date, file_id) cursor
+
+    direction "n" returns the rows after the cursor and "p" the rows before
+    it. Returns (rows, has_prev, has_next).
+    """
+    conn = get_db()
+    columns = 'SELECT file_id, display_name, original_name, file_size, upload_date FROM files'
+
+    if direction == "p" and cursor is not None:
+        rows = conn.execute(
+            f'{columns} WHERE (upload_date, file_id) > (?, ?) ORDER BY upload_date, file_id LIMIT ?',
+            (cursor[0], cursor[1], limit + 1)).fetchall()
+        has_prev = len(rows) > limit
+        rows = rows[:limit]
+        rows.reverse()
+        return rows, has_prev, True
+
+    if direction == "n" and cursor is not None:
+        rows = conn.execute(
+            f'{columns} WHERE (upload_date, file_id) < (?, ?) ORDER BY upload_date DESC, file_id DESC LIMIT ?',
+            (cursor[0], cursor[1], limit + 1)).fetchall()
+        return rows[:limit], True, len(rows) > limit
+
+    rows = conn.execute(
+        f'{columns} ORDER BY upload_date DESC, file_id DESC LIMIT ?', (limit + 1,)).fetchall()
+    return rows[:limit], False, len(rows) > limit
+
+
+def get_stats():
+    """Get the running totals maintained by the stats triggers"""
+    return dict(get_db().execute('SELECT name, value FROM stats').fetchall())
+
+
+def count_files():
+    """Get the number of files"""
+    row = get_db().execute("SELECT value FROM stats WHERE name = 'file_count'").fetchone()
+    return row[0] if row else 0
+
+
+def parse_page_data(payload):
+    """Split a page button payload ("<n|p>:<position>:<cursor>") into (direction, position, cursor)"""
+    parts = payload.split(":", 2)
+    if len(parts) < 3:
+        return None, 1, None
+    cursor_date, _, cursor_id = parts[2].rpartition("|")
+    try:
+        position = max(1, int(parts[1]))
+    except ValueError:
+        return None, 1, None
+    return parts[0], position, (cursor_date, cursor_id)
+
+
+def load_file_page(payload, page_size):
+    """Load the page of files addressed by a page button payload
+
+    Returns (rows, position, has_prev, has_next, total).
+    """
+    direction, position, cursor = parse_page_data(payload)
+    files, has_prev, has_next = get_files_page(page_size, direction, cursor)
+    if not files and cursor is not None:
+        # The rows around the cursor are gone - start over
+        files, has_prev, has_next = get_files_page(page_size)
+    if not has_prev:
+        position = 1
+    return files, position, has_prev, has_next, count_files()
+
+
+def load_user_page(payload, pending):
+    """Load the page of users addressed by a page button payload
+
+    Returns (rows, direction, position, has_prev, has_next, total).
+    """
+    direction, position, cursor = parse_page_data(payload)
+    if cursor is not None:
+        try:
+            cursor = (cursor[0], int(cursor[1]))
+        except ValueError:
+            direction, position, cursor = None, 1, None
+    users, has_prev, has_next = get_users_page(USERS_PAGE_SIZE, pending, direction, cursor)
+    if not users and cursor is not None:
+        # The users around the cursor are gone - start over
+        direction = None
+        users, has_prev, has_next = get_users_page(USERS_PAGE_SIZE, pending)
+    if not has_prev:
+        position = 1
+
+    stats = get_stats()
+    total = stats.get('user_count', 0)
+    if pending:
+        total -= stats.get('approved_users', 0)
+    return users, direction, position, has_prev, has_next, total
+
+
+def build_search_query(text):
+    """Turn user search text into an FTS5 query matching every word as a prefix"""
+    tokens = re.findall(r"\w+", text.lower())
+    return " ".join(f'"{token}"*' for token in tokens)
+
+
+def search_files(text, limit, offset=0):
+    """Search file names, best matches first
+
+    Returns (rows, total) where rows are (file_id, display_name, file_size).
+    """
+    match = build_search_query(text)
+    if not match:
+        return [], 0
+
+    conn = get_db()
+    total = conn.execute('SELECT COUNT(*) FROM files_fts WHERE files_fts MATCH ?', (match,)).fetchone()[0]
+    if not total:
+        return [], 0
+
+    rows = conn.execute(
+        'SELECT f.file_id, f.display_name, f.file_size FROM files_fts '
+        'JOIN files f ON f.rowid = files_fts.rowid '
+        'WHERE files_fts MATCH ? ORDER BY bm25(files_fts, 2.0, 1.0) LIMIT ? OFFSET ?',
+        (match, limit, offset)).fetchall()
+    return rows, total
+
+
+def get_user_stats(user_id):
+    """Get (download_count, join_date) for a user"""
+    row = get_db().execute('SELECT download_count, join_date FROM users WHERE user_id = ?', (user_id,)).fetchone()
+    return row if row else (0, None)
+
+
+def get_popular_files(limit=5):
+    """Get the most downloaded files"""
+    return get_db().execute(
+        'SELECT file_id, display_name, download_count FROM files '
+        'WHERE download_count > 0 ORDER BY download_count DESC LIMIT ?', (limit,)
+    ).fetchall()
+
+
+def count_file_references(filepath):
+    """Count catalog rows that point at a file on disk"""
+    return get_db().execute('SELECT COUNT(*) FROM files WHERE filepath = ?', (filepath,)).fetchone()[0]
 
 
 def get_file(file_id):
-    """Get file by ID"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('SELECT * FROM files WHERE file_id = ?', (file_id,))
-    file = cursor.fetchone()
-    conn.close()
-    return file
+    """Get file by ID, as a row readable by column name
+
+    Everything except the thumbnail BLOB, which only an upload needs -
+    see get_media_thumbnail().
+    """
+    cursor = get_db().execute(
+        'SELECT file_id, display_name, original_name, filepath, file_size, upload_date, uploaded_by, '
+        'telegram_file_id, media_duration, media_width, media_height, media_performer, media_title '
+        'FROM files WHERE file_id = ?', (file_id,))
+    cursor.row_factory = sqlite3.Row
+    return cursor.fetchone()
 
 
 def delete_file_from_db(file_id):
     """Delete file from database"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('DELETE FROM files WHERE file_id = ?', (file_id,))
-    deleted = cursor.rowcount
-    conn.commit()
-    conn.close()
+    conn = get_db()
+    with conn:
+        deleted = conn.execute('DELETE FROM files WHERE file_id = ?', (file_id,)).rowcount
+    bump_data_version("files")
     return deleted > 0
 
 
 def update_file_display_name(file_id, display_name):
     """Update display name of a file"""
-    conn = sqlite3.connect(DB_FILE)
-    cursor = conn.cursor()
-    cursor.execute('UPDATE files SET display_name = ? WHERE file_id = ?', (display_name, file_id))
-    conn.commit()
-    conn.close()
+    conn = get_db()
+    with conn:
+        conn.execute('UPDATE files SET display_name = ? WHERE file_id = ?', (display_name, file_id))
+    bump_data_version("files")
+
+
+def get_files_without_media(limit):
+    """Get (file_id, display_name, filepath) of files whose metadata has not been extracted"""
+    return get_db().execute(
+        'SELECT file_id, display_name, filepath FROM files WHERE media_extracted = 0 LIMIT ?', (limit,)
+    ).fetchall()
+
+
+def save_media_metadata(results):
+    """Store extracted metadata, given (file_id, metadata) pairs - None marks a file as done without any"""
+    rows = []
+    for file_id, metadata in results:
+        metadata = metadata or {}
+        rows.append((metadata.get("duration"), metadata.get("width"), metadata.get("height"),
+                     metadata.get("performer"), metadata.get("title"), metadata.get("thumbnail"), file_id))
+    conn = get_db()
+    with conn:
+        conn.executemany(
+            'UPDATE files SET media_duration = ?, media_width = ?, media_height = ?, media_performer = ?, '
+            'media_title = ?, media_thumbnail = ?, media_extracted = 1 WHERE file_id = ?', rows)
+
+
+def get_media_metadata(file_data):
+    """Get the media metadata of a get_file() row as send keyword arguments (only the known ones)"""
+    names = ("duration", "width", "height", "performer", "title")
+    return {name: file_data[f"media_{name}"] for name in names if file_data[f"media_{name}"] is not None}
+
+
+def get_media_thumbnail(file_id):
+    """Get the stored thumbnail of a file, or None"""
+    row = get_db().execute('SELECT media_thumbnail FROM files WHERE file_id = ?', (file_id,)).fetchone()
+    return row[0] if row else None
+
+
+def set_telegram_file_id(file_id, telegram_file_id):
+    """Remember (or clear) the Telegram file reference for a file"""
+    conn = get_db()
+    with conn:
+        conn.execute('UPDATE files SET telegram_file_id = ? WHERE file_id = ?', (telegram_file_id, file_id))
+
+
+# ========== DOWNLOAD ACCOUNTING ==========
+# Downloads are counted in memory and written out by flush_downloads()
+_pending_downloads = {}
+_pending_downloads_lock = threading.Lock()
+
+
+def record_download(user_id, file_id):
+    """Count a download without touching the database"""
+    key = (user_id, file_id)
+    with _pending_downloads_lock:
+        _pending_downloads[key] = _pending_downloads.get(key, 0) + 1
+
+
+def get_pending_download_count(user_id):
+    """Get downloads by a user that have not been flushed yet"""
+    with _pending_downloads_lock:
+        return sum(count for (uid, _), count in _pending_downloads.items() if uid == user_id)
+
+
+def flush_downloads():
+    """Write batched download counts to the database in one transaction"""
+    global _pending_downloads
+    with _pending_downloads_lock:
+        batch = _pending_downloads
+        _pending_downloads = {}
+    if not batch:
+        return 0
+
+    per_user = {}
+    per_file = {}
+    for (user_id, file_id), count in batch.items():
+        per_user[user_id] = per_user.get(user_id, 0) + count
+        per_file[file_id] = per_file.get(file_id, 0) + count
+
+    conn = get_db()
+    try:
+        with conn:
+            conn.executemany(
+                'INSERT INTO downloads (user_id, file_id, download_count, last_download) '
+                'VALUES (?, ?, ?, CURRENT_TIMESTAMP) '
+                'ON CONFLICT (user_id, file_id) DO UPDATE SET '
+                'download_count = download_count + excluded.download_count, '
+                'last_download = excluded.last_download',
+                [(user_id, file_id, count) for (user_id, file_id), count in batch.items()])
+            conn.executemany('UPDATE users SET download_count = download_count + ? WHERE user_id = ?',
+                             [(count, user_id) for user_id, count in per_user.items()])
+            conn.executemany('UPDATE files SET download_count = download_count + ? WHERE file_id = ?',
+                             [(count, file_id) for file_id, count in per_file.items()])
+    except sqlite3.Error:
+        # Put the batch back so the next flush retries it
+        with _pending_downloads_lock:
+            for key, count in batch.items():
+                _pending_downloads[key] = _pending_downloads.get(key, 0) + count
+        raise
+    bump_data_version("downloads")
+    return sum(batch.values())
+
+
+async def download_flush_loop():
+    """Periodically flush batched download counts"""
+    while True:
+        await asyncio.sleep(DOWNLOAD_FLUSH_INTERVAL)
+        try:
+            await run_storage(flush_downloads)
+        except Exception as e:
+            logger.warning(f"Failed to flush download counts: {e}")
+
+
+# ========== STORAGE SERVICE ==========
+_storage_executor = ThreadPoolExecutor(max_workers=STORAGE_WORKERS, thread_name_prefix="storage")
+_storage_slots = None
+
+# Counters for the storage thread pool
+storage_stats = {
+    "submitted": 0,
+    "completed": 0,
+    "failed": 0,
+    "waiting": 0,
+    "in_flight": 0,
+    "peak_in_flight": 0,
+    "busy_seconds": 0.0
+}
+
+
+async def run_storage(func, *args, **kwargs):
+    """Run a blocking database or filesystem call on the storage thread pool"""
+    global _storage_slots
+    if _storage_slots is None:
+        _storage_slots = asyncio.Semaphore(STORAGE_MAX_PENDING)
+
+    storage_stats["submitted"] += 1
+    storage_stats["waiting"] += 1
+    async with _storage_slots:
+        storage_stats["waiting"] -= 1
+        storage_stats["in_flight"] += 1
+        storage_stats["peak_in_flight"] = max(storage_stats["peak_in_flight"], storage_stats["in_flight"])
+        started = time.perf_counter()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(
+                _storage_executor, functools.partial(func, *args, **kwargs)
+            )
+        except Exception:
+            storage_stats["failed"] += 1
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            storage_stats["in_flight"] -= 1
+            storage_stats["completed"] += 1
+            storage_stats["busy_seconds"] += elapsed
+            # Keyed by name - bound methods like handle.read are new objects on every call
+            name = getattr(func, "__qualname__", "call")
+            histogram = storage_latency.get(name)
+            if histogram is None:
+                histogram = storage_latency[name] = Histogram()
+            histogram.observe(elapsed)
+            trace = _current_trace.get()
+            if trace is not None:
+                trace[get_storage_span(name)] += elapsed
+
+
+async def check_user_approved(user_id):
+    """Check approval from the cache, only going to the database on a miss"""
+    if user_id == ADMIN_ID:
+        return True
+
+    approved = get_cached_approval(user_id)
+    if approved is None:
+        approved = await run_storage(load_user_approval, user_id)
+    return approved
+
+
+def shutdown_storage():
+    """Wait for queued storage jobs and stop the thread pool"""
+    _storage_executor.shutdown(wait=True)
+
+
+def read_file_bytes(filepath):
+    """Read a whole file from disk"""
+    with open(filepath, 'rb') as file:
+        return file.read()
+
+
+def remove_file_if_exists(filepath):
+    """Delete a file from disk if it is still there"""
+    if os.path.exists(filepath):
+        os.remove(filepath)
+
+
+# ========== UPLOAD SESSIONS ==========
+# An upload session holds what /add learned about a file (its Telegram
+# file_id and original name) until the admin picks Rename or Keep Original.
+# Sessions expire after UPLOAD_SESSION_TTL and are swept periodically.
+class MemorySessionStore:
+    """Upload sessions in a bounded in-process dict (lost on restart)"""
+
+    blocking = False
+
+    def __init__(self, ttl, max_sessions):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, user_id, data):
+        with self._lock:
+            self._sessions[user_id] = (time.time() + self.ttl, data)
+            self._sessions.move_to_end(user_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def get(self, user_id):
+        with self._lock:
+            entry = self._sessions.get(user_id)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._sessions[user_id]
+                return None
+            return entry[1]
+
+    def pop(self, user_id):
+        with self._lock:
+            entry = self._sessions.pop(user_id, None)
+        if entry is None or entry[0] < time.time():
+            return None
+        return entry[1]
+
+    def delete(self, user_id):
+        with self._lock:
+            self._sessions.pop(user_id, None)
+
+    def sweep(self):
+        now = time.time()
+        with self._lock:
+            expired = [user_id for user_id, (expires_at, _) in self._sessions.items() if expires_at < now]
+            for user_id in expired:
+                del self._sessions[user_id]
+        return len(expired)
+
+    def count(self):
+        return len(self._sessions)
+
+
+class SQLiteSessionStore:
+    """Upload sessions in the upload_sessions table (survive restarts)"""
+
+    blocking = True
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._count = 0
+
+    def _recount(self, conn):
+        # Kept in memory so count() never needs a connection - /metrics calls it from its own threads
+        self._count = conn.execute('SELECT COUNT(*) FROM upload_sessions').fetchone()[0]
+
+    def put(self, user_id, data):
+        conn = get_db()
+        with conn:
+            conn.execute('INSERT OR REPLACE INTO upload_sessions (user_id, data, expires_at) VALUES (?, ?, ?)',
+                         (user_id, json.dumps(data), time.time() + self.ttl))
+            self._recount(conn)
+
+    def get(self, user_id):
+        row = get_db().execute('SELECT data FROM upload_sessions WHERE user_id = ? AND expires_at >= ?',
+                               (user_id, time.time())).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def pop(self, user_id):
+        conn = get_db()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data, expires_at FROM upload_sessions WHERE user_id = ?',
+                               (user_id,)).fetchone()
+            conn.execute('DELETE FROM upload_sessions WHERE user_id = ?', (user_id,))
+            self._recount(conn)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        if row is None or row[1] < time.time():
+            return None
+        return json.loads(row[0])
+
+    def delete(self, user_id):
+        conn = get_db()
+        with conn:
+            conn.execute('DELETE FROM upload_sessions WHERE user_id = ?', (user_id,))
+            self._recount(conn)
+
+    def sweep(self):
+        conn = get_db()
+        with conn:
+            removed = conn.execute('DELETE FROM upload_sessions WHERE expires_at < ?', (time.time(),)).rowcount
+            self._recount(conn)
+        return removed
+
+    def count(self):
+        """Sessions as of the last change (sessions left from before a restart are counted by the first sweep)"""
+        return self._count
+
+
+if UPLOAD_SESSION_BACKEND == "sqlite":
+    upload_sessions = SQLiteSessionStore(UPLOAD_SESSION_TTL)
+else:
+    upload_sessions = MemorySessionStore(UPLOAD_SESSION_TTL, UPLOAD_SESSION_MAX)
+
+
+async def call_session_store(method, *args):
+    """Call an upload session store method, off the event loop if it blocks"""
+    if upload_sessions.blocking:
+        return await run_storage(method, *args)
+    return method(*args)
+
+
+async def upload_session_sweep_loop():
+    """Drop expired upload sessions at startup and periodically after that"""
+    while True:
+        try:
+            removed = await call_session_store(upload_sessions.sweep)
+            if removed:
+                logger.info(f"Dropped {removed} expired upload sessions")
+        except Exception as e:
+            logger.warning(f"Failed to sweep upload sessions: {e}")
+        await asyncio.sleep(UPLOAD_SESSION_SWEEP_INTERVAL)
+
+
+# ========== BLOB STORAGE ==========
+# Uploads live in BLOBS_DIR under their SHA-256 digest, so identical content
+# is stored once however many catalog rows point at it. _blob_lock makes
+# "reuse or create blob + insert row" and "count references + unlink"
+# atomic with respect to each other.
+_blob_lock = threading.Lock()
+
+
+def get_blob_path(content_hash):
+    """Get where the blob for a content hash is stored"""
+    return os.path.join(BLOBS_DIR, content_hash[:2], content_hash)
+
+
+def store_upload(temp_path, content_hash, display_name, original_name, file_size, uploaded_by):
+    """Move a finished upload into blob storage and add it to the catalog
+
+    If the blob already exists the upload is a duplicate and the temporary
+    file is simply dropped. Returns the new file ID.
+    """
+    blob_path = get_blob_path(content_hash)
+    with _blob_lock:
+        if os.path.exists(blob_path):
+            os.remove(temp_path)
+        else:
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(temp_path, blob_path)
+
+        try:
+            return save_file(None, display_name, original_name, blob_path, file_size, uploaded_by, content_hash)
+        except Exception:
+            if count_file_references(blob_path) == 0:
+                remove_file_if_exists(blob_path)
+            raise
+
+
+def release_file(filepath):
+    """Unlink a file from disk once no catalog row references it
+
+    Returns True if the file was removed.
+    """
+    with _blob_lock:
+        if count_file_references(filepath) > 0:
+            return False
+        remove_file_if_exists(filepath)
+        return True
+
+
+# ========== BULK IMPORT ==========
+# /import (and "python local_file_bot.py import") catalogs files that were
+# copied into FILES_DIR by hand. Hidden entries - the blob store and
+# partial uploads - are skipped. /import, the file watcher and the startup
+# sync can run at once, so _catalog_lock makes "look up known paths +
+# insert the new ones" atomic - otherwise two of them could both add the
+# same file (filepath is not unique: deduplicated uploads share a blob).
+_import_running = False
+_catalog_lock = threading.Lock()
+
+
+def walk_files_dir(root=FILES_DIR, unreadable=None):
+    """Yield (filepath, size, mtime) for every visible file under root
+
+    Directories that cannot be listed are skipped and, if given a list,
+    added to unreadable.
+    """
+    directories = [root]
+    while directories:
+        directory = directories.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.startswith("."):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        yield entry.path, stat.st_size, stat.st_mtime
+        except OSError as e:
+            logger.warning(f"Skipping {directory} during import: {e}")
+            if unreadable is not None:
+                unreadable.append(directory)
+
+
+def iter_import_batches(batch_size=IMPORT_BATCH_SIZE, unreadable=None):
+    """Group scanned files into batches of batch_size"""
+    batch = []
+    for item in walk_files_dir(unreadable=unreadable):
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def next_import_batch(batches):
+    """Scan the next batch of files, or return None when done"""
+    return next(batches, None)
+
+
+def import_batch(batch, uploaded_by=None):
+    """Catalog one batch of scanned files in a single transaction
+
+    Files already known by path with the same size and mtime are skipped.
+    Changed files lose their stored Telegram reference so /get uploads the
+    new content. Returns (added, updated).
+    """
+    with _catalog_lock:
+        conn = get_db()
+        placeholders = ",".join("?" * len(batch))
+        known = {
+            filepath: (file_size, file_mtime)
+            for filepath, file_size, file_mtime in conn.execute(
+                f'SELECT filepath, file_size, file_mtime FROM files WHERE filepath IN ({placeholders})',
+                [filepath for filepath, _, _ in batch])
+        }
+
+        new_rows = []
+        changed_rows = []
+        for filepath, file_size, file_mtime in batch:
+            if filepath not in known:
+                name = os.path.basename(filepath)
+                new_rows.append((generate_file_id(), name, name, filepath, file_size, uploaded_by, file_mtime))
+            elif known[filepath] != (file_size, file_mtime):
+                changed_rows.append((file_size, file_mtime, filepath))
+
+        try:
+            with conn:
+                conn.executemany(
+                    'INSERT INTO files (file_id, display_name, original_name, filepath, file_size, uploaded_by, file_mtime) '
+                    'VALUES (?, ?, ?, ?, ?, ?, ?)', new_rows)
+                conn.executemany(
+                    'UPDATE files SET file_size = ?, file_mtime = ?, telegram_file_id = NULL, media_extracted = 0 '
+                    'WHERE filepath = ?', changed_rows)
+        except sqlite3.IntegrityError:
+            # An ID clashed - fall back to row-by-row inserts, which retry with fresh IDs
+            for file_id, name, _, filepath, file_size, uploaded_by, file_mtime in new_rows:
+                file_id = save_file(None, name, name, filepath, file_size, uploaded_by)
+                with conn:
+                    conn.execute('UPDATE files SET file_mtime = ? WHERE file_id = ?', (file_mtime, file_id))
+            with conn:
+                conn.executemany(
+                    'UPDATE files SET file_size = ?, file_mtime = ?, telegram_file_id = NULL, media_extracted = 0 '
+                    'WHERE filepath = ?', changed_rows)
+        if new_rows or changed_rows:
+            bump_data_version("files")
+        return len(new_rows), len(changed_rows)
+
+
+def format_import_progress(scanned, added, updated, elapsed, done=False, removed=0):
+    """Build the /import progress message"""
+    rate = scanned / max(elapsed, 0.001)
+    title = "✅ *Import Finished*" if done else "📥 *Importing Files...*"
+    return (
+        f"{title}\n\n"
+        f"🔍 Scanned: {scanned}\n"
+        f"➕ Added: {added}\n"
+        f"♻️ Updated: {updated}\n"
+        f"⏭️ Unchanged: {scanned - added - updated}\n"
+        + (f"🗑️ Removed (gone from disk): {removed}\n" if done else "") +
+        f"⚡ {rate:.0f} files/s in {elapsed:.1f}s"
+    )
+
+
+async def run_import(edit, uploaded_by=None):
+    """Import FILES_DIR in the background, reporting progress through edit()"""
+    global _import_running
+    _import_running = True
+    started = time.monotonic()
+    last_edit = 0.0
+    scanned = added = updated = 0
+    seen = set()
+    unreadable = []
+    try:
+        batches = iter_import_batches(unreadable=unreadable)
+        while True:
+            batch = await run_storage(next_import_batch, batches)
+            if batch is None:
+                break
+            batch_added, batch_updated = await run_storage(import_batch, batch, uploaded_by)
+            seen.update(filepath for filepath, _, _ in batch)
+            scanned += len(batch)
+            added += batch_added
+            updated += batch_updated
+
+            now = time.monotonic()
+            if now - last_edit >= INGEST_PROGRESS_INTERVAL:
+                last_edit = now
+                try:
+                    await edit(format_import_progress(scanned, added, updated, now - started), parse_mode="Markdown")
+                except Exception as e:
+                    logger.debug(f"Import progress update failed: {e}")
+
+        removed = await run_storage(remove_missing_files, seen, unreadable)
+        await edit(format_import_progress(scanned, added, updated, time.monotonic() - started, done=True, removed=removed),
+                   parse_mode="Markdown")
+    except Exception as e:
+        logger.exception("Import failed")
+        await edit(f"❌ *Import failed:* `{str(e)[:100]}`", parse_mode="Markdown")
+    finally:
+        _import_running = False
+        wake_media_worker()
+
+
+# ========== FILE WATCHER ==========
+# Keeps the catalog in step with FILES_DIR while the bot runs. One full
+# scan at startup catches what changed while it was down; after that,
+# events come from watchdog (inotify on Linux) or, without it, from
+# comparing periodic scans, and are applied in debounced batches.
+watcher_stats = {"events": 0, "batches": 0, "added": 0, "updated": 0, "moved": 0, "removed": 0}
+
+
+def is_watched_path(path):
+    """Check a path is inside FILES_DIR and not hidden"""
+    parts = os.path.relpath(path, FILES_DIR).split(os.sep)
+    return parts[0] != ".." and not any(part.startswith(".") for part in parts)
+
+
+def scan_files_dir(unreadable=None):
+    """Map every visible file under FILES_DIR to its (size, mtime)"""
+    return {filepath: (size, mtime) for filepath, size, mtime in walk_files_dir(unreadable=unreadable)}
+
+
+def remove_catalog_path(conn, path):
+    """Delete catalog rows for a file, or for everything under a directory"""
+    prefix = path + os.sep
+    return conn.execute('DELETE FROM files WHERE filepath = ? OR substr(filepath, 1, ?) = ?',
+                        (path, len(prefix), prefix)).rowcount
+
+
+def remove_missing_files(on_disk, unreadable=()):
+    """Delete catalog rows for visible files under FILES_DIR that a full scan did not find
+
+    on_disk holds every path the scan saw. Kept regardless:
+    - rows under directories the scan could not list (unreadable)
+    - rows with a Telegram reference, which /get can still send without
+      the local copy
+    - everything, if the scan found no files at all - an unmounted mount
+      point or a bot started from the wrong directory looks just like
+      that, and must not empty the catalog
+    Returns the number of rows removed.
+    """
+    conn = get_db()
+    kept_prefixes = tuple(os.path.join(directory, "") for directory in unreadable)
+    with _catalog_lock:
+        catalogued = [(filepath, telegram_file_id)
+                      for filepath, telegram_file_id in conn.execute('SELECT filepath, telegram_file_id FROM files')
+                      if is_watched_path(filepath) and not filepath.startswith(kept_prefixes)]
+        if not on_disk and catalogued:
+            logger.warning(f"No files found in {os.path.abspath(FILES_DIR)} but {len(catalogued)} are catalogued "
+                           "there - not removing any")
+            return 0
+        # Checked on disk again - the scan may be older than a file another sync has just catalogued
+        gone = [(filepath,) for filepath, telegram_file_id in catalogued
+                if filepath not in on_disk and telegram_file_id is None and not os.path.exists(filepath)]
+        if gone:
+            with conn:
+                conn.executemany('DELETE FROM files WHERE filepath = ?', gone)
+            bump_data_version("files")
+    return len(gone)
+
+
+def sync_catalog(snapshot, unreadable=()):
+    """Import new and changed files from a scan_files_dir() snapshot and drop rows for files not in it
+
+    Returns (added, updated, removed).
+    """
+    batch = [(filepath, size, mtime) for filepath, (size, mtime) in snapshot.items()]
+    added = updated = 0
+    for start in range(0, len(batch), IMPORT_BATCH_SIZE):
+        batch_added, batch_updated = import_batch(batch[start:start + IMPORT_BATCH_SIZE])
+        added += batch_added
+        updated += batch_updated
+    return added, updated, remove_missing_files(snapshot, unreadable)
+
+
+def apply_file_changes(paths, moves):
+    """Apply a batch of file events to the catalog
+
+    Moves are applied first so renamed files keep their IDs. Each changed
+    path is then checked on disk and either imported or removed.
+    Returns (added, updated, moved, removed).
+    """
+    conn = get_db()
+    moved = removed = 0
+    with conn:
+        for src, dest in moves:
+            src_prefix = src + os.sep
+            removed += remove_catalog_path(conn, dest)
+            moved += conn.execute(
+                'UPDATE files SET filepath = ? || substr(filepath, ?) WHERE filepath = ? OR substr(filepath, 1, ?) = ?',
+                (dest, len(src) + 1, src, len(src_prefix), src_prefix)).rowcount
+
+    batch = []
+    for path in paths:
+        try:
+            if os.path.isdir(path):
+                batch.extend(walk_files_dir(path))
+            else:
+                stat = os.stat(path)
+                batch.append((path, stat.st_size, stat.st_mtime))
+        except FileNotFoundError:
+            with conn:
+                removed += remove_catalog_path(conn, path)
+    if moved or removed:
+        bump_data_version("files")
+
+    added = updated = 0
+    for start in range(0, len(batch), IMPORT_BATCH_SIZE):
+        batch_added, batch_updated = import_batch(batch[start:start + IMPORT_BATCH_SIZE])
+        added += batch_added
+        updated += batch_updated
+    return added, updated, moved, removed
+
+
+class FilesDirEventHandler(FileSystemEventHandler):
+    """Forwards watchdog events from the observer thread to a FileWatcher"""
+
+    def __init__(self, watcher):
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.event_type == "moved":
+            self.watcher.add_threadsafe(event.src_path, event.dest_path)
+        elif event.event_type in ("created", "deleted") or (event.event_type == "modified" and not event.is_directory):
+            self.watcher.add_threadsafe(event.src_path)
+
+
+class FileWatcher:
+    """Collects changed paths under FILES_DIR and applies them in debounced batches"""
+
+    def __init__(self, debounce=WATCH_DEBOUNCE, max_delay=WATCH_MAX_DELAY):
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.paths = {}
+        self.moves = []
+        self.changed = None
+        self.loop = None
+        self.observer = None
+
+    def add(self, path, dest=None):
+        """Queue a changed path, or a move from path to dest"""
+        path = os.path.normpath(path)
+        if dest is not None:
+            dest = os.path.normpath(dest)
+            if is_watched_path(dest):
+                if is_watched_path(path):
+                    self.moves.append((path, dest))
+                self.paths[dest] = None
+                self.notify()
+                return
+        # Plain events, and moves to a hidden name (treated as a delete)
+        if is_watched_path(path):
+            self.paths[path] = None
+            self.notify()
+
+    def add_threadsafe(self, path, dest=None):
+        """Queue a change from another thread"""
+        self.loop.call_soon_threadsafe(self.add, path, dest)
+
+    def notify(self):
+        watcher_stats["events"] += 1
+        self.changed.set()
+
+    async def apply_pending(self):
+        """Write every queued change to the catalog"""
+        if not self.paths and not self.moves:
+            return
+        paths, moves = list(self.paths), self.moves
+        self.paths, self.moves = {}, []
+        added, updated, moved, removed = await run_storage(apply_file_changes, paths, moves)
+        self.record_sync(added, updated, moved, removed)
+
+    async def reconcile(self):
+        """Sync the catalog with one full scan of FILES_DIR and return the scan"""
+        unreadable = []
+        snapshot = await run_storage(scan_files_dir, unreadable)
+        try:
+            added, updated, removed = await run_storage(sync_catalog, snapshot, unreadable)
+            self.record_sync(added, updated, 0, removed)
+        except Exception:
+            logger.exception("Syncing the catalog with FILES_DIR failed")
+        return snapshot
+
+    def record_sync(self, added, updated, moved, removed):
+        watcher_stats["batches"] += 1
+        watcher_stats["added"] += added
+        watcher_stats["updated"] += updated
+        watcher_stats["moved"] += moved
+        watcher_stats["removed"] += removed
+        if added or updated:
+            wake_media_worker()
+        if added or updated or moved or removed:
+            logger.info(f"Catalog synced: {added} added, {updated} updated, {moved} moved, {removed} removed")
+
+    async def run(self):
+        """Apply changes once events stop arriving for the debounce period"""
+        while True:
+            await self.changed.wait()
+            started = time.monotonic()
+            while True:
+                self.changed.clear()
+                await asyncio.sleep(self.debounce)
+                if not self.changed.is_set() or time.monotonic() - started >= self.max_delay:
+                    break
+            try:
+                await self.apply_pending()
+            except Exception:
+                logger.exception("Applying file changes failed")
+
+    async def poll(self, interval=WATCH_POLL_INTERVAL):
+        """Find changes by comparing scans of FILES_DIR"""
+        snapshot = await self.reconcile()
+        while True:
+            await asyncio.sleep(interval)
+            current = await run_storage(scan_files_dir)
+            for path, info in current.items():
+                if snapshot.get(path) != info:
+                    self.add(path)
+            for path in snapshot.keys() - current.keys():
+                self.add(path)
+            snapshot = current
+
+    def start(self):
+        """Start watching FILES_DIR and return the tasks doing it"""
+        self.loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+        tasks = [asyncio.create_task(self.run())]
+        if Observer is not None:
+            self.observer = Observer()
+            self.observer.schedule(FilesDirEventHandler(self), FILES_DIR, recursive=True)
+            self.observer.daemon = True
+            self.observer.start()
+            logger.info(f"Watching {FILES_DIR} for changes")
+            # After the observer starts, so nothing changed during the scan is missed
+            tasks.append(asyncio.create_task(self.reconcile()))
+        else:
+            tasks.append(asyncio.create_task(self.poll()))
+            logger.info(f"watchdog not installed, scanning {FILES_DIR} every {WATCH_POLL_INTERVAL}s")
+        return tasks
+
+    def stop(self):
+        """Stop the watchdog observer, if one is running"""
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+            self.observer = None
+
+
+file_watcher = FileWatcher()
+
+
+# ========== UPLOAD INGEST ==========
+_ingest_slots = None
+_http_client = None
+
+
+def get_http_client():
+    """Get the shared HTTP client used to stream files from Telegram"""
+    global _http_client
+    if _http_client is None:
+        _http_client = httpx.AsyncClient(timeout=httpx.Timeout(30.0, read=120.0))
+    return _http_client
+
+
+async def close_http_client():
+    """Close the shared HTTP client"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
+async def iter_telegram_file(file_obj):
+    """Yield the contents of a Telegram file in INGEST_CHUNK_SIZE chunks"""
+    source = file_obj.file_path
+
+    # A local Bot API server hands out paths on this machine instead of URLs
+    if not source.startswith(("http://", "https://")):
+        handle = await run_storage(open, source, 'rb')
+        try:
+            while True:
+                chunk = await run_storage(handle.read, INGEST_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            await run_storage(handle.close)
+        return
+
+    async with get_http_client().stream("GET", source) as response:
+        response.raise_for_status()
+        async for chunk in response.aiter_bytes(INGEST_CHUNK_SIZE):
+            yield chunk
+
+
+def open_temp_upload():
+    """Create a hidden temporary file in FILES_DIR for an incoming upload"""
+    fd, temp_path = tempfile.mkstemp(dir=FILES_DIR, prefix=".", suffix=".part")
+    return os.fdopen(fd, 'wb'), temp_path
+
+
+def write_upload_chunk(handle, digest, chunk):
+    """Append a chunk to an upload and feed it to the running hash"""
+    handle.write(chunk)
+    digest.update(chunk)
+
+
+def finish_temp_upload(handle):
+    """Flush and fsync a finished upload so it survives a crash once renamed"""
+    handle.flush()
+    os.fsync(handle.fileno())
+    handle.close()
+
+
+def discard_temp_upload(handle, temp_path):
+    """Throw away a partial upload"""
+    handle.close()
+    remove_file_if_exists(temp_path)
+
+
+class IngestProgress:
+    """Edits a status message with upload progress, at most every INGEST_PROGRESS_INTERVAL seconds"""
+
+    def __init__(self, edit, name, total_size):
+        self.edit = edit
+        self.name = name
+        self.total_size = total_size
+        self.received = 0
+        self.started = time.monotonic()
+        self.last_edit = 0.0
+
+    async def show(self, text):
+        try:
+            await self.edit(text, parse_mode="Markdown")
+        except Exception as e:
+            # "Message is not modified" and flood limits are not worth failing an upload for
+            logger.debug(f"Progress update failed: {e}")
+
+    async def advance(self, size):
+        self.received += size
+        now = time.monotonic()
+        if now - self.last_edit < INGEST_PROGRESS_INTERVAL:
+            return
+        self.last_edit = now
+
+        received_mb = self.received / (1024 * 1024)
+        speed_mb = received_mb / max(now - self.started, 0.001)
+        if self.total_size:
+            percent = min(100, self.received * 100 // self.total_size)
+            bar = "▓" * (percent // 10) + "░" * (10 - percent // 10)
+            progress = f"{bar} {percent}%\n📦 {received_mb:.1f} / {self.total_size / (1024 * 1024):.1f} MB"
+        else:
+            progress = f"📦 {received_mb:.1f} MB"
+        await self.show(f"⏬ *Saving* `{self.name}`\n\n{progress}\n⚡ {speed_mb:.1f} MB/s")
+
+
+async def ingest_telegram_file(file_obj, name, edit):
+    """Stream a Telegram file to a temporary file, hashing it on the way
+
+    Returns (temp_path, file_size, content_hash) for store_upload(), which
+    moves the fsynced temporary file into blob storage. At most
+    MAX_CONCURRENT_INGESTS uploads are saved at once; edit() is used to
+    report queueing and progress.
+    """
+    global _ingest_slots
+    if _ingest_slots is None:
+        _ingest_slots = asyncio.Semaphore(MAX_CONCURRENT_INGESTS)
+
+    progress = IngestProgress(edit, name, getattr(file_obj, "file_size", None))
+    if _ingest_slots.locked():
+        await progress.show(f"⏳ *Queued* `{name}`\n\n💫 Waiting for another upload to finish...")
+
+    async with _ingest_slots:
+        await progress.show(f"⏬ *Saving* `{name}`...")
+        handle, temp_path = await run_storage(open_temp_upload)
+        digest = hashlib.sha256()
+        try:
+            async for chunk in iter_telegram_file(file_obj):
+                await run_storage(write_upload_chunk, handle, digest, chunk)
+                await progress.advance(len(chunk))
+            await run_storage(finish_temp_upload, handle)
+            transfer_stats["add_bytes_received"] += progress.received
+            return temp_path, progress.received, digest.hexdigest()
+        except BaseException:
+            await asyncio.shield(run_storage(discard_temp_upload, handle, temp_path))
+            raise
+
+
+async def save_pending_upload(bot, file_data, display_name, uploaded_by, edit, note, reply_markup=None):
+    """Download a claimed upload session's file and catalog it, reporting through edit()
+
+    Run with spawn_background_task() - awaited in the handler it would
+    hold the admin's chat (see ChatOrderedUpdateProcessor) for the whole
+    transfer.
+    """
+    try:
+        # Fetch a fresh download link - old ones expire
+        file_obj = await bot.get_file(file_data['telegram_file_id'])
+        temp_path, file_size, content_hash = await ingest_telegram_file(file_obj, display_name, edit)
+        file_id = await run_storage(store_upload, temp_path, content_hash, display_name,
+                                    file_data['original_name'], file_size, uploaded_by)
+        wake_media_worker()
+    except Exception as e:
+        logger.warning(f"Saving upload {display_name} failed: {e}")
+        await edit(
+            f"❌ *Error saving file:*\n`{str(e)[:100]}`",
+            reply_markup=reply_markup,
+            parse_mode="Markdown"
+        )
+        return
+
+    size_mb = file_size / (1024 * 1024)
+
+    await edit(
+        f"✅ *File Uploaded Successfully!*\n\n"
+        f"📄 Name: {display_name}\n"
+        f"🆔 ID: `{file_id}`\n"
+        f"📦 Size: {size_mb:.1f} MB\n\n"
+        f"💫 Download with: `/get {file_id}`\n\n"
+        f"✨ *{note}*",
+        reply_markup=reply_markup,
+        parse_mode="Markdown"
+    )
+
+
+# ========== FILE SENDING ==========
+PHOTO_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif')
+AUDIO_EXTENSIONS = ('.mp3', '.m4a', '.wav', '.flac')
+VIDEO_EXTENSIONS = ('.mp4', '.avi', '.mov', '.mkv')
+
+
+def get_media_kind(ext):
+    """Get how a file with this extension is sent: photo, audio, video or document"""
+    if ext in PHOTO_EXTENSIONS:
+        return "photo"
+    elif ext in AUDIO_EXTENSIONS:
+        return "audio"
+    elif ext in VIDEO_EXTENSIONS:
+        return "video"
+    return "document"
+
+
+async def send_file_message(message, ext, media, display_name, metadata=None):
+    """Send a file as photo/audio/video/document based on its extension
+
+    metadata holds what media_metadata_loop() extracted (duration, width,
+    height, performer, title, thumbnail). The thumbnail is only sent along
+    with an upload - Telegram ignores it when resending by file_id.
+    """
+    metadata = metadata or {}
+    thumbnail = metadata.get("thumbnail") if not isinstance(media, str) else None
+    kind = get_media_kind(ext)
+    if kind == "photo":
+        return await message.reply_photo(photo=media, filename=display_name, caption=f"📸 {display_name}")
+    elif kind == "audio":
+        return await message.reply_audio(
+            audio=media, filename=display_name, caption=f"🎵 {display_name}",
+            title=metadata.get("title") or display_name, performer=metadata.get("performer"),
+            duration=metadata.get("duration"), thumbnail=thumbnail)
+    elif kind == "video":
+        return await message.reply_video(
+            video=media, filename=display_name, caption=f"🎬 {display_name}",
+            duration=metadata.get("duration"), width=metadata.get("width"), height=metadata.get("height"),
+            thumbnail=thumbnail, supports_streaming=True)
+    else:
+        return await message.reply_document(document=media, filename=display_name)
+
+
+def get_sent_file_id(message):
+    """Get the Telegram file_id of the media in a sent message"""
+    attachment = message.effective_attachment
+    if isinstance(attachment, (list, tuple)):
+        attachment = attachment[-1] if attachment else None
+    return getattr(attachment, "file_id", None)
+
+
+# ========== MEDIA METADATA ==========
+# Audio and video files get their duration, size, tags and a thumbnail
+# read once, in worker processes, and stored in the catalog. mutagen,
+# Pillow and ffprobe/ffmpeg are each optional; whatever is missing is
+# simply not extracted.
+_media_executor = None
+_media_wakeup = None
+
+# Counters for media metadata extraction
+media_stats = {
+    "extracted": 0,
+    "skipped": 0,
+    "failed": 0
+}
+
+
+def make_thumbnail(source):
+    """Shrink an image to a Telegram thumbnail (JPEG, within 320x320 and 200 kB)"""
+    with Image.open(source) as image:
+        image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        output = io.BytesIO()
+        image.save(output, "JPEG", quality=85, optimize=True)
+    data = output.getvalue()
+    return data if len(data) <= THUMBNAIL_MAX_BYTES else None
+
+
+def find_cover_art(audio):
+    """Get embedded cover art bytes from a mutagen file, if any"""
+    pictures = getattr(audio, "pictures", None)  # FLAC
+    if pictures:
+        return pictures[0].data
+    tags = audio.tags
+    if tags is None:
+        return None
+    if hasattr(tags, "getall"):  # ID3 (MP3, WAV)
+        frames = tags.getall("APIC")
+        return frames[0].data if frames else None
+    covers = tags.get("covr")  # MP4 (M4A)
+    return bytes(covers[0]) if covers else None
+
+
+def read_audio_metadata(filepath, metadata):
+    """Read duration, artist, title and cover art with mutagen"""
+    audio = mutagen.File(filepath)
+    if audio is None:
+        return
+    length = getattr(audio.info, "length", None)
+    if length:
+        metadata["duration"] = int(round(length))
+
+    easy = mutagen.File(filepath, easy=True)
+    if easy is not None and easy.tags:
+        for tag, key in (("artist", "performer"), ("title", "title")):
+            values = easy.tags.get(tag)
+            if values:
+                metadata[key] = str(values[0])[:256]
+
+    if Image is not None:
+        cover = find_cover_art(audio)
+        if cover:
+            metadata["thumbnail"] = make_thumbnail(io.BytesIO(cover))
+
+
+def read_ffprobe_metadata(filepath, kind, metadata):
+    """Read duration (and, for video, the frame size) with ffprobe"""
+    result = subprocess.run(
+        [FFPROBE, "-v", "error", "-show_entries", "format=duration:stream=codec_type,width,height",
+         "-of", "json", filepath],
+        capture_output=True, timeout=MEDIA_TOOL_TIMEOUT, check=True)
+    info = json.loads(result.stdout or b"{}")
+
+    duration = info.get("format", {}).get("duration")
+    if duration and "duration" not in metadata:
+        metadata["duration"] = int(round(float(duration)))
+    if kind == "video":
+        for stream in info.get("streams", []):
+            if stream.get("codec_type") == "video" and stream.get("width"):
+                metadata["width"] = stream["width"]
+                metadata["height"] = stream["height"]
+                break
+
+
+def grab_video_frame(filepath, duration):
+    """Grab a frame near the start of a video as a thumbnail with ffmpeg"""
+    offset = min(1.0, duration / 2) if duration else 0
+    result = subprocess.run(
+        [FFMPEG, "-v", "error", "-ss", f"{offset:.2f}", "-i", filepath, "-frames:v", "1",
+         "-vf", f"scale={THUMBNAIL_SIZE}:{THUMBNAIL_SIZE}:force_original_aspect_ratio=decrease",
+         "-q:v", "5", "-f", "image2pipe", "-vcodec", "mjpeg", "-"],
+        capture_output=True, timeout=MEDIA_TOOL_TIMEOUT, check=True)
+    return result.stdout if 0 < len(result.stdout) <= THUMBNAIL_MAX_BYTES else None
+
+
+def extract_media_metadata(filepath, kind):
+    """Read what can be read about an audio or video file
+
+    Runs in a worker process. Returns a dict with any of duration, width,
+    height, performer, title and thumbnail.
+    """
+    metadata = {}
+    if kind == "audio" and mutagen is not None:
+        read_audio_metadata(filepath, metadata)
+    if FFPROBE and (kind == "video" or "duration" not in metadata):
+        read_ffprobe_metadata(filepath, kind, metadata)
+    if kind == "video" and FFMPEG:
+        metadata["thumbnail"] = grab_video_frame(filepath, metadata.get("duration"))
+    return {key: value for key, value in metadata.items() if value is not None}
+
+
+def can_extract_media():
+    """Check at least one metadata tool is available"""
+    return MEDIA_METADATA and (mutagen is not None or FFPROBE is not None)
+
+
+def get_media_executor():
+    """Get the process pool used for metadata extraction"""
+    global _media_executor
+    if _media_executor is None:
+        # Spawned, not forked - the bot process has threads (and locks) running
+        _media_executor = ProcessPoolExecutor(MEDIA_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+    return _media_executor
+
+
+def shutdown_media_executor():
+    """Stop the metadata worker processes"""
+    global _media_executor
+    if _media_executor is not None:
+        _media_executor.shutdown(wait=False, cancel_futures=True)
+        _media_executor = None
+
+
+def wake_media_worker():
+    """Have media_metadata_loop() look for new files now instead of at its next scan"""
+    if _media_wakeup is not None:
+        _media_wakeup.set()
+
+
+async def extract_in_pool(file_id, filepath, kind):
+    """Extract metadata for one file in the process pool, returning (file_id, metadata or None)"""
+    try:
+        metadata = await asyncio.get_running_loop().run_in_executor(
+            get_media_executor(), extract_media_metadata, filepath, kind)
+        media_stats["extracted"] += 1
+        return file_id, metadata
+    except BrokenProcessPool:
+        raise
+    except Exception as e:
+        # Unreadable or unsupported files are marked done so they are not retried forever
+        logger.info(f"No metadata for {file_id} ({filepath}): {e}")
+        media_stats["failed"] += 1
+        return file_id, None
+
+
+async def extract_media_batch():
+    """Extract and store metadata for the next batch of files that have none
+
+    Returns the number of files handled.
+    """
+    rows = await run_storage(get_files_without_media, MEDIA_BATCH_SIZE)
+    jobs = []
+    results = []
+    for file_id, display_name, filepath in rows:
+        ext = (os.path.splitext(display_name or "")[1] or os.path.splitext(filepath)[1]).lower()
+        kind = get_media_kind(ext)
+        if kind in ("audio", "video"):
+            jobs.append((file_id, filepath, kind))
+        else:
+            results.append((file_id, None))
+            media_stats["skipped"] += 1
+
+    outcomes = await asyncio.gather(*(extract_in_pool(*job) for job in jobs), return_exceptions=True)
+    broken = []
+    for job, outcome in zip(jobs, outcomes):
+        if isinstance(outcome, BrokenProcessPool):
+            broken.append(job)
+        elif isinstance(outcome, BaseException):
+            raise outcome
+        else:
+            results.append(outcome)
+
+    if broken:
+        # A worker died (a native crash in a parser, say) and took every file in flight with it. Retry those
+        # one at a time so only the file that crashes it is given up on - otherwise the batch would come
+        # back forever.
+        logger.warning(f"Media metadata worker died, retrying {len(broken)} files one at a time")
+        shutdown_media_executor()
+        for file_id, filepath, kind in broken:
+            try:
+                results.append(await extract_in_pool(file_id, filepath, kind))
+            except BrokenProcessPool:
+                logger.warning(f"Media metadata worker crashed on {file_id} ({filepath}), skipping it")
+                shutdown_media_executor()
+                media_stats["failed"] += 1
+                results.append((file_id, None))
+
+    if results:
+        await run_storage(save_media_metadata, results)
+    return len(results)
+
+
+async def media_metadata_loop():
+    """Keep extracting metadata for new audio and video files"""
+    global _media_wakeup
+    _media_wakeup = asyncio.Event()
+    while True:
+        try:
+            if await extract_media_batch():
+                continue
+        except Exception:
+            logger.exception("Media metadata extraction failed")
+
+        _media_wakeup.clear()
+        try:
+            await asyncio.wait_for(_media_wakeup.wait(), MEDIA_SCAN_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+# ========== SEARCH RESULTS ==========
+def render_search_results(query, results, offset, total):
+    """Build the search results message and its page keyboard"""
+    message = f"🔍 *Results for '{query}':* ✨\n\n"
+    for file_id, display_name, file_size in results:
+        size_mb = file_size / (1024 * 1024) if file_size else 0
+        display = display_name[:22] + "..." if len(display_name) > 25 else display_name
+        message += f"• `{file_id}`\n"
+        message += f"  📄 {display}\n"
+        message += f"  📦 {size_mb:.1f}MB\n"
+        message += f"  ⬇️ `/get {file_id}`\n\n"
+
+    if total > len(results):
+        message += f"✨ Showing {offset + 1}-{offset + len(results)} of {total} results\n"
+
+    nav = []
+    if offset > 0:
+        nav.append(create_glass_button("Prev", f"search_page:{max(0, offset - SEARCH_PAGE_SIZE)}", "◀️"))
+    if offset + len(results) < total:
+        nav.append(create_glass_button("Next", f"search_page:{offset + len(results)}", "▶️"))
+
+    return message, InlineKeyboardMarkup([nav]) if nav else None
+
+
+# ========== SCREEN RENDERING ==========
+# List screens are built in the storage pool and cached by render_screen()
+def render_browse_files(payload):
+    """Build the Browse Files page addressed by a page button payload"""
+    files, position, has_prev, has_next, total = load_file_page(payload, BROWSE_PAGE_SIZE)
+    if not files:
+        return ("📭 *No Files Yet*\n\n💫 Admin hasn't uploaded any files yet.",
+                create_back_keyboard("main_menu"))
+
+    lines = ["📁 *Available Files*\n\n"]
+    for idx, (file_id, display_name, original_name, file_size, upload_date) in enumerate(files, position):
+        size_mb = file_size / (1024 * 1024) if file_size else 0
+        display = display_name[:22] + "..." if len(display_name) > 25 else display_name
+        lines.append(f"{idx}. *{file_id}*\n"
+                     f"   📄 {display}\n"
+                     f"   📦 {size_mb:.1f}MB\n"
+                     f"   ⬇️ `/get {file_id}`\n\n")
+
+    if has_prev or has_next:
+        lines.append(f"✨ Showing {position}-{position + len(files) - 1} of {total} files\n\n")
+    lines.append("💡 *Tip:* Tap `/get file_id` to copy the command!")
+
+    return "".join(lines), create_page_keyboard(
+        "browse_files", position, BROWSE_PAGE_SIZE, files, has_prev, has_next, "main_menu")
+
+
+def render_admin_files(payload):
+    """Build the admin file list page addressed by a page button payload"""
+    files, position, has_prev, has_next, total = load_file_page(payload, ADMIN_FILES_PAGE_SIZE)
+    if not files:
+        return "📭 *No Files Yet*", create_back_keyboard("admin_panel")
+
+    lines = ["📋 *All Files*\n\n"]
+    for file_id, display_name, original_name, file_size, upload_date in files:
+        size_mb = file_size / (1024 * 1024) if file_size else 0
+        lines.append(f"• `{file_id}`\n"
+                     f"  📄 {display_name[:25]}{'...' if len(display_name) > 25 else ''}\n"
+                     f"  📦 {size_mb:.1f}MB\n"
+                     f"  🗑️ Delete: `/delete {file_id}`\n\n")
+
+    if has_prev or has_next:
+        lines.append(f"✨ Showing {position}-{position + len(files) - 1} of {total} files\n")
+
+    return "".join(lines), create_page_keyboard(
+        "admin_files", position, ADMIN_FILES_PAGE_SIZE, files, has_prev, has_next, "admin_panel")
+
+
+def message_length(text):
+    """Length of text as Telegram counts it (UTF-16 code units)"""
+    return len(text.encode("utf-16-le")) // 2
+
+
+def format_user_entry(user, pending):
+    """Format one user for the All Users or Pending Users list"""
+    user_id, username, first_name, is_allowed, join_date = user
+    if pending:
+        return (f"👤 *{first_name or 'User'}*\n"
+                f"   🆔 ID: `{user_id}`\n"
+                f"   📱 Username: @{username or 'none'}\n"
+                f"   📅 Joined: {join_date[:10] if join_date else 'Today'}\n"
+                f"   ✨ Approve: `/approve {user_id}`\n\n")
+    return (f"{'✅' if is_allowed else '❌'} *{first_name or 'User'}*\n"
+            f"   🆔 ID: `{user_id}`\n"
+            f"   📊 Status: {'Approved' if is_allowed else 'Pending'}\n"
+            f"   ✨ Approve: `/approve {user_id}`\n\n")
+
+
+def render_users_page(screen, payload):
+    """Build one page of All Users or Pending Users
+
+    Only one page of users is loaded. If its entries would not fit in one
+    message, entries are dropped from the far end of the page (in the
+    direction of travel) and the page buttons pick up from there.
+    """
+    pending = screen == "pending_users"
+    users, direction, position, has_prev, has_next, total = load_user_page(payload, pending)
+    if not users:
+        if pending:
+            return "✅ *All users are approved!* ✨", create_back_keyboard("admin_panel")
+        return "📭 *No Users Yet*", create_back_keyboard("admin_panel")
+
+    header = "⏳ *Pending Users*\n\n" if pending else "👥 *All Users*\n\n"
+    entries = [format_user_entry(user, pending) for user in users]
+    budget = MESSAGE_CHAR_LIMIT - message_length(header) - 100  # Room for the "Showing" line
+    if direction == "p":
+        # Keep the entries next to the page we came from
+        users.reverse()
+        entries.reverse()
+    kept = 0
+    for entry in entries:
+        budget -= message_length(entry)
+        if budget < 0:
+            break
+        kept += 1
+    if kept < len(entries):
+        dropped = len(entries) - kept
+        users, entries = users[:kept], entries[:kept]
+        if direction == "p":
+            has_prev = True
+            position += dropped
+        else:
+            has_next = True
+    if direction == "p":
+        users.reverse()
+        entries.reverse()
+
+    message = header + "".join(entries)
+    if has_prev or has_next:
+        message += f"✨ Showing {position}-{position + len(users) - 1} of {total} users\n"
+    return message, create_page_keyboard(
+        screen, position, USERS_PAGE_SIZE, users, has_prev, has_next, "admin_panel")
+
+
+def render_admin_stats():
+    """Build the bot statistics screen"""
+    stats = get_stats()
+    total_users = stats.get('user_count', 0)
+    approved_users = stats.get('approved_users', 0)
+
+    lines = ["📊 *Bot Statistics*\n\n",
+             f"📁 Total Files: {stats.get('file_count', 0)}\n",
+             f"💾 Total Size: {stats.get('total_size', 0) / (1024 * 1024):.1f} MB\n",
+             f"👥 Total Users: {total_users}\n",
+             f"✅ Approved Users: {approved_users}\n",
+             f"⏳ Pending Users: {total_users - approved_users}\n"]
+
+    popular = get_popular_files()
+    if popular:
+        lines.append("\n🔥 *Most Downloaded*\n")
+        for file_id, display_name, count in popular:
+            display = display_name[:22] + "..." if len(display_name) > 25 else display_name
+            lines.append(f"• {display} (`{file_id}`) - {count}\n")
+        lines.append("\n")
+    lines.append(f"👑 Admin: Fyodor ✨")
+
+    return "".join(lines), create_back_keyboard("admin_panel")
+
+
+async def render_screen(screen, payload, tables, render, *args):
+    """Get a rendered (message, keyboard) from the cache, or render it in the storage pool
+
+    The table versions are read before rendering, so a write that lands
+    while rendering only makes the cached copy newer than its key.
+    """
+    key = (screen, payload, get_data_version(*tables))
+    rendered = get_cached_render(key)
+    if rendered is None:
+        rendered = await run_storage(render, *args)
+        cache_render(key, rendered)
+    return rendered
 
 
 # ========== COMMAND HANDLERS ==========
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Start command"""
     user = update.effective_user
-    add_or_update_user(user.id, user.username, user.first_name)
+    await run_storage(add_or_update_user, user.id, user.username, user.first_name)
     user_is_admin = is_admin(user.id)
-    user_is_approved = is_user_approved(user.id)
+    user_is_approved = await check_user_approved(user.id)
 
     if user_is_admin:
         message = "👑 *Welcome Admin!*\n\n"
@@ -302,361 +2416,307 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 
-async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle button clicks"""
-    query = update.callback_query
-    await query.answer()
-    user = query.from_user
-    data = query.data
-    user_is_admin = is_admin(user.id)
-    user_is_approved = is_user_approved(user.id)
-
-    # Handle main menu
-    if data == "main_menu":
-        if user_is_admin:
-            await query.edit_message_text(
-                "👑 *Admin Mode*\n\n✨ Select an option:",
-                reply_markup=create_main_keyboard(user.id, True, True),
-                parse_mode="Markdown"
-            )
-        elif user_is_approved:
-            await query.edit_message_text(
-                f"✨ *Welcome {user.first_name}!*\n\n🌟 Select an option:",
-                reply_markup=create_main_keyboard(user.id, False, True),
-                parse_mode="Markdown"
-            )
-        else:
-            await query.edit_message_text(
-                f"⏳ *Approval Needed*\n\nYour ID: `{user.id}`\n\n💫 Send this to admin.",
-                reply_markup=create_main_keyboard(user.id, False, False),
-                parse_mode="Markdown"
-            )
-
-    # Handle browse files
-    elif data == "browse_files":
-        if not user_is_approved and not user_is_admin:
-            await query.answer("❌ You need approval first!", show_alert=True)
-            return
-
-        files = get_all_files()
-        if not files:
-            await query.edit_message_text(
-                "📭 *No Files Yet*\n\n💫 Admin hasn't uploaded any files yet.",
-                reply_markup=create_back_keyboard("main_menu"),
-                parse_mode="Markdown"
-            )
-            return
-
-        message = "📁 *Available Files*\n\n"
-        for idx, (file_id, display_name, original_name, file_size) in enumerate(files[:10], 1):
-            size_mb = file_size / (1024 * 1024) if file_size else 0
-            if len(display_name) > 25:
-                display = display_name[:22] + "..."
-            else:
-                display = display_name
-
-            message += f"{idx}. *{file_id}*\n"
-            message += f"   📄 {display}\n"
-            message += f"   📦 {size_mb:.1f}MB\n"
-            message += f"   ⬇️ `/get {file_id}`\n\n"
+# ========== CALLBACK ROUTES ==========
+# Button callback data is "<route>" or "<route>:<payload>". Each route is a
+# coroutine taking (query, context, payload) and is listed in
+# CALLBACK_ROUTES with the permission it needs.
+PUBLIC = "public"  # Anyone
+APPROVED = "approved"  # Approved users and the admin
+ADMIN = "admin"  # The admin only
 
-        if len(files) > 10:
-            message += f"✨ Showing 10 of {len(files)} files\n\n"
-        message += "💡 *Tip:* Tap `/get file_id` to copy the command!"
 
+async def main_menu_callback(query, context, payload):
+    """Show the main menu for the user's status"""
+    user = query.from_user
+    if is_admin(user.id):
         await query.edit_message_text(
-            message,
-            reply_markup=create_back_keyboard("main_menu"),
+            "👑 *Admin Mode*\n\n✨ Select an option:",
+            reply_markup=create_main_keyboard(user.id, True, True),
             parse_mode="Markdown"
         )
-
-    # Handle rename options
-    elif data == "rename_file":
-        user_id = user.id
-        if user_id in user_rename_context:
-            file_data = user_rename_context[user_id]
-            await query.edit_message_text(
-                "✏️ *Rename File*\n\n"
-                "✨ Please send me the new name for this file.\n\n"
-                f"📄 Current name: `{file_data['original_name']}`\n\n"
-                "*Examples:*\n"
-                "• `Vacation Photo.jpg`\n"
-                "• `Meeting Notes.pdf`\n"
-                "• `Music Album.mp3`\n\n"
-                "💫 *Type the new name and send it...*",
-                parse_mode="Markdown"
-            )
-
-    elif data == "keep_original":
-        user_id = user.id
-        if user_id in user_rename_context:
-            file_data = user_rename_context[user_id]
-            file_id = generate_file_id()
-            display_name = file_data['original_name']
-            filepath = os.path.join(FILES_DIR, display_name)
-
-            # Save the file
-            await file_data['file_obj'].download_to_drive(filepath)
-            file_size = os.path.getsize(filepath)
-            save_file(file_id, display_name, file_data['original_name'], filepath, file_size, user.id)
-
-            size_mb = file_size / (1024 * 1024)
-
-            # Clear the context
-            del user_rename_context[user_id]
-
-            await query.edit_message_text(
-                f"✅ *File Uploaded Successfully!*\n\n"
-                f"📄 Name: {display_name}\n"
-                f"🆔 ID: `{file_id}`\n"
-                f"📦 Size: {size_mb:.1f} MB\n\n"
-                f"💫 Download with: `/get {file_id}`\n\n"
-                f"✨ *Original name kept as requested*",
-                reply_markup=create_back_keyboard("admin_panel"),
-                parse_mode="Markdown"
-            )
-
-    elif data == "cancel_upload":
-        user_id = user.id
-        if user_id in user_rename_context:
-            del user_rename_context[user_id]
+    elif await check_user_approved(user.id):
         await query.edit_message_text(
-            "❌ *Upload Cancelled*\n\n"
-            "💫 File upload has been cancelled.\n"
-            "You can try again anytime!",
-            reply_markup=create_back_keyboard("admin_panel"),
+            f"✨ *Welcome {user.first_name}!*\n\n🌟 Select an option:",
+            reply_markup=create_main_keyboard(user.id, False, True),
             parse_mode="Markdown"
         )
-
-    # Handle search info
-    elif data == "search_info":
+    else:
         await query.edit_message_text(
-            "🔍 *Search Files*\n\n"
-            "✨ To search for files, use the command:\n"
-            "`/search keyword`\n\n"
-            "*Examples:*\n"
-            "`/search music` 🎵\n"
-            "`/search photo` 📸\n"
-            "`/search document` 📄",
-            reply_markup=create_back_keyboard("main_menu"),
+            f"⏳ *Approval Needed*\n\nYour ID: `{user.id}`\n\n💫 Send this to admin.",
+            reply_markup=create_main_keyboard(user.id, False, False),
             parse_mode="Markdown"
         )
 
-    # Handle my stats
-    elif data == "my_stats":
-        files = get_all_files()
-        user_files = [f for f in files if f[0].startswith(f"user_{user.id}_")]
 
-        message = f"📊 *Your Statistics*\n\n"
-        message += f"👤 Name: {user.first_name}\n"
-        message += f"🆔 ID: `{user.id}`\n"
-        message += f"📅 Joined: Today\n"
-        message += f"📁 Files Downloaded: {len(user_files)}\n"
-        message += f"✅ Status: {'Approved' if user_is_approved or user_is_admin else 'Pending'}"
+async def browse_files_callback(query, context, payload):
+    """Show a page of Browse Files"""
+    message, keyboard = await render_screen("browse_files", payload, ("files",), render_browse_files, payload)
+    await query.edit_message_text(message, reply_markup=keyboard, parse_mode="Markdown")
+
 
+async def rename_file_callback(query, context, payload):
+    """Ask for a new name for the pending upload"""
+    file_data = await call_session_store(upload_sessions.get, query.from_user.id)
+    if file_data:
         await query.edit_message_text(
-            message,
-            reply_markup=create_back_keyboard("main_menu"),
+            "✏️ *Rename File*\n\n"
+            "✨ Please send me the new name for this file.\n\n"
+            f"📄 Current name: `{file_data['original_name']}`\n\n"
+            "*Examples:*\n"
+            "• `Vacation Photo.jpg`\n"
+            "• `Meeting Notes.pdf`\n"
+            "• `Music Album.mp3`\n\n"
+            "💫 *Type the new name and send it...*",
             parse_mode="Markdown"
         )
 
-    # Handle my ID
-    elif data == "my_id":
+
+async def keep_original_callback(query, context, payload):
+    """Save the pending upload under its original name"""
+    user = query.from_user
+    # Claim the upload so a second tap can't save it twice
+    file_data = await call_session_store(upload_sessions.pop, user.id)
+    if not file_data:
+        return
+
+    spawn_background_task(save_pending_upload(
+        context.bot, file_data, file_data['original_name'], user.id, query.edit_message_text,
+        "Original name kept as requested", reply_markup=create_back_keyboard("admin_panel")))
+
+
+async def cancel_upload_callback(query, context, payload):
+    """Drop the pending upload"""
+    await call_session_store(upload_sessions.delete, query.from_user.id)
+    await query.edit_message_text(
+        "❌ *Upload Cancelled*\n\n"
+        "💫 File upload has been cancelled.\n"
+        "You can try again anytime!",
+        reply_markup=create_back_keyboard("admin_panel"),
+        parse_mode="Markdown"
+    )
+
+
+async def search_info_callback(query, context, payload):
+    """Explain /search"""
+    await query.edit_message_text(
+        "🔍 *Search Files*\n\n"
+        "✨ To search for files, use the command:\n"
+        "`/search keyword`\n\n"
+        "*Examples:*\n"
+        "`/search music` 🎵\n"
+        "`/search photo` 📸\n"
+        "`/search document` 📄",
+        reply_markup=create_back_keyboard("main_menu"),
+        parse_mode="Markdown"
+    )
+
+
+async def search_page_callback(query, context, payload):
+    """Show another page of the last /search"""
+    search_query = context.user_data.get("search_query")
+    if not search_query:
         await query.edit_message_text(
-            f"🆔 *Your User ID*\n\n"
-            f"`{user.id}`\n\n"
-            f"✨ Send this to admin for approval.",
+            "🔍 *Search expired*\n\n✨ Run `/search keyword` again.",
             reply_markup=create_back_keyboard("main_menu"),
             parse_mode="Markdown"
         )
+        return
 
-    # Handle admin panel
-    elif data == "admin_panel":
-        if not user_is_admin:
-            await query.answer("❌ Admin only!", show_alert=True)
-            return
-
+    try:
+        offset = max(0, int(payload))
+    except ValueError:
+        offset = 0
+    results, total = await run_storage(search_files, search_query, SEARCH_PAGE_SIZE, offset)
+    if not results and offset:
+        offset = 0
+        results, total = await run_storage(search_files, search_query, SEARCH_PAGE_SIZE)
+    if not results:
         await query.edit_message_text(
-            "👑 *Admin Panel*\n\n✨ Select an option:",
-            reply_markup=create_admin_keyboard(),
+            f"🔍 *No results for:* `{search_query}`",
             parse_mode="Markdown"
         )
+        return
 
-    # Handle upload info
-    elif data == "upload_info":
-        if not user_is_admin:
-            await query.answer("❌ Admin only!", show_alert=True)
-            return
+    message, keyboard = render_search_results(search_query, results, offset, total)
+    await query.edit_message_text(message, reply_markup=keyboard, parse_mode="Markdown")
 
-        await query.edit_message_text(
-            "➕ *Upload File*\n\n"
-            "✨ *How to upload:*\n"
-            "1. Send any file to this bot 📁\n"
-            "2. Reply to it with `/add` ✨\n"
-            "3. Choose to rename or keep original ✏️\n"
-            "4. File gets ID like `file_abc123` 🆔\n\n"
-            "💫 Users can download with:\n"
-            "`/get file_abc123`",
-            reply_markup=create_back_keyboard("admin_panel"),
-            parse_mode="Markdown"
-        )
 
-    # Handle manage users
-    elif data == "manage_users":
-        if not user_is_admin:
-            await query.answer("❌ Admin only!", show_alert=True)
-            return
+async def my_stats_callback(query, context, payload):
+    """Show the user's own statistics"""
+    user = query.from_user
+    download_count, join_date = await run_storage(get_user_stats, user.id)
+    download_count += get_pending_download_count(user.id)
+    approved = is_admin(user.id) or await check_user_approved(user.id)
+
+    message = f"📊 *Your Statistics*\n\n"
+    message += f"👤 Name: {user.first_name}\n"
+    message += f"🆔 ID: `{user.id}`\n"
+    message += f"📅 Joined: {join_date[:10] if join_date else 'Today'}\n"
+    message += f"📁 Files Downloaded: {download_count}\n"
+    message += f"✅ Status: {'Approved' if approved else 'Pending'}"
+
+    await query.edit_message_text(
+        message,
+        reply_markup=create_back_keyboard("main_menu"),
+        parse_mode="Markdown"
+    )
 
-        users = get_all_users()
-        if not users:
-            message = "📭 *No Users Yet*"
-        else:
-            message = "👥 *All Users*\n\n"
-            for user_id, username, first_name, is_allowed, join_date in users:
-                status = "✅" if is_allowed else "❌"
-                message += f"{status} *{first_name or 'User'}*\n"
-                message += f"   🆔 ID: `{user_id}`\n"
-                message += f"   📊 Status: {'Approved' if is_allowed else 'Pending'}\n"
-                message += f"   ✨ Approve: `/approve {user_id}`\n\n"
 
-        await query.edit_message_text(
-            message,
-            reply_markup=create_back_keyboard("admin_panel"),
-            parse_mode="Markdown"
-        )
+async def my_id_callback(query, context, payload):
+    """Show the user's ID"""
+    await query.edit_message_text(
+        f"🆔 *Your User ID*\n\n"
+        f"`{query.from_user.id}`\n\n"
+        f"✨ Send this to admin for approval.",
+        reply_markup=create_back_keyboard("main_menu"),
+        parse_mode="Markdown"
+    )
 
-    # Handle pending users
-    elif data == "pending_users":
-        if not user_is_admin:
-            await query.answer("❌ Admin only!", show_alert=True)
-            return
 
-        pending = get_pending_users()
-        if not pending:
-            await query.edit_message_text(
-                "✅ *All users are approved!* ✨",
-                reply_markup=create_back_keyboard("admin_panel"),
-                parse_mode="Markdown"
-            )
-            return
+async def admin_panel_callback(query, context, payload):
+    """Show the admin panel"""
+    await query.edit_message_text(
+        "👑 *Admin Panel*\n\n✨ Select an option:",
+        reply_markup=create_admin_keyboard(),
+        parse_mode="Markdown"
+    )
 
-        message = "⏳ *Pending Users*\n\n"
-        for user_id, username, first_name, join_date in pending:
-            message += f"👤 *{first_name or 'User'}*\n"
-            message += f"   🆔 ID: `{user_id}`\n"
-            message += f"   📱 Username: @{username or 'none'}\n"
-            message += f"   📅 Joined: {join_date[:10] if join_date else 'Today'}\n"
-            message += f"   ✨ Approve: `/approve {user_id}`\n\n"
 
-        await query.edit_message_text(
-            message,
-            reply_markup=create_back_keyboard("admin_panel"),
-            parse_mode="Markdown"
-        )
+async def upload_info_callback(query, context, payload):
+    """Explain how to upload"""
+    await query.edit_message_text(
+        "➕ *Upload File*\n\n"
+        "✨ *How to upload:*\n"
+        "1. Send any file to this bot 📁\n"
+        "2. Reply to it with `/add` ✨\n"
+        "3. Choose to rename or keep original ✏️\n"
+        "4. File gets ID like `file_abc123` 🆔\n\n"
+        "💫 Users can download with:\n"
+        "`/get file_abc123`",
+        reply_markup=create_back_keyboard("admin_panel"),
+        parse_mode="Markdown"
+    )
 
-    # Handle delete info
-    elif data == "delete_info":
-        if not user_is_admin:
-            await query.answer("❌ Admin only!", show_alert=True)
-            return
 
-        await query.edit_message_text(
-            "🗑️ *Delete File*\n\n"
-            "✨ To delete a file, use:\n"
-            "`/delete file_id`\n\n"
-            "*Example:*\n"
-            "`/delete file_abc123`\n\n"
-            "⚠️ *Warning:* This cannot be undone!",
-            reply_markup=create_back_keyboard("admin_panel"),
-            parse_mode="Markdown"
-        )
+async def manage_users_callback(query, context, payload):
+    """Show a page of All Users"""
+    message, keyboard = await render_screen(
+        "manage_users", payload, ("users",), render_users_page, "manage_users", payload)
+    await query.edit_message_text(message, reply_markup=keyboard, parse_mode="Markdown")
 
-    # Handle admin files
-    elif data == "admin_files":
-        if not user_is_admin:
-            await query.answer("❌ Admin only!", show_alert=True)
-            return
 
-        files = get_all_files()
-        if not files:
-            await query.edit_message_text(
-                "📭 *No Files Yet*",
-                reply_markup=create_back_keyboard("admin_panel"),
-                parse_mode="Markdown"
-            )
-            return
+async def pending_users_callback(query, context, payload):
+    """Show a page of Pending Users"""
+    message, keyboard = await render_screen(
+        "pending_users", payload, ("users",), render_users_page, "pending_users", payload)
+    await query.edit_message_text(message, reply_markup=keyboard, parse_mode="Markdown")
 
-        message = "📋 *All Files*\n\n"
-        for file_id, display_name, original_name, file_size in files[:15]:
-            size_mb = file_size / (1024 * 1024) if file_size else 0
-            message += f"• `{file_id}`\n"
-            message += f"  📄 {display_name[:25]}{'...' if len(display_name) > 25 else ''}\n"
-            message += f"  📦 {size_mb:.1f}MB\n"
-            message += f"  🗑️ Delete: `/delete {file_id}`\n\n"
 
-        if len(files) > 15:
-            message += f"✨ ... and {len(files) - 15} more files\n"
+async def delete_info_callback(query, context, payload):
+    """Explain /delete"""
+    await query.edit_message_text(
+        "🗑️ *Delete File*\n\n"
+        "✨ To delete a file, use:\n"
+        "`/delete file_id`\n\n"
+        "*Example:*\n"
+        "`/delete file_abc123`\n\n"
+        "⚠️ *Warning:* This cannot be undone!",
+        reply_markup=create_back_keyboard("admin_panel"),
+        parse_mode="Markdown"
+    )
 
-        await query.edit_message_text(
-            message,
-            reply_markup=create_back_keyboard("admin_panel"),
-            parse_mode="Markdown"
-        )
 
-    # Handle admin stats
-    elif data == "admin_stats":
-        if not user_is_admin:
-            await query.answer("❌ Admin only!", show_alert=True)
-            return
+async def admin_files_callback(query, context, payload):
+    """Show a page of the admin file list"""
+    message, keyboard = await render_screen("admin_files", payload, ("files",), render_admin_files, payload)
+    await query.edit_message_text(message, reply_markup=keyboard, parse_mode="Markdown")
+
+
+async def admin_stats_callback(query, context, payload):
+    """Show bot statistics"""
+    message, keyboard = await render_screen(
+        "admin_stats", payload, ("files", "users", "downloads"), render_admin_stats)
+    # Cache figures are live, so they go below the cached part
+    message += (f"\n\n⚡ Cache hits: screens {cache_hit_rate(render_cache_stats):.0%}, "
+                f"approvals {cache_hit_rate(approval_cache_stats):.0%}")
+    await query.edit_message_text(message, reply_markup=keyboard, parse_mode="Markdown")
+
+
+async def show_help_callback(query, context, payload):
+    """Show help for the user's status"""
+    if is_admin(query.from_user.id):
+        help_text = "❓ *Admin Help*\n\n"
+        help_text += "✨ *Commands:*\n"
+        help_text += "• `/add` - Upload file (reply to file)\n"
+        help_text += "• `/approve ID` - Approve user\n"
+        help_text += "• `/delete ID` - Delete file\n"
+        help_text += "• `/import` - Add files already in the folder\n"
+        help_text += "• `/profile [seconds]` - Profile the bot\n"
+        help_text += "• `/search` - Search files\n"
+        help_text += "• `/get ID` - Download file\n\n"
+        help_text += "💫 *Use beautiful buttons for easy navigation!*"
+    else:
+        help_text = "❓ *Help Center*\n\n"
+        help_text += "1. Get your ID from 'My ID' button 🆔\n"
+        help_text += "2. Send it to admin for approval ✨\n"
+        help_text += "3. Once approved, you can:\n"
+        help_text += "   • Browse files 📁\n"
+        help_text += "   • Download files ⬇️\n"
+        help_text += "   • Search files 🔍\n\n"
+        help_text += "✨ *Commands after approval:*\n"
+        help_text += "• `/get file_id` - Download\n"
+        help_text += "• `/search keyword` - Search"
+
+    await query.edit_message_text(
+        help_text,
+        reply_markup=create_back_keyboard("main_menu"),
+        parse_mode="Markdown"
+    )
 
-        files = get_all_files()
-        users = get_all_users()
-        total_size = sum(f[3] for f in files if f[3])
-        approved_users = sum(1 for u in users if u[3] == 1)
-        pending_users = sum(1 for u in users if u[3] == 0)
 
-        message = "📊 *Bot Statistics*\n\n"
-        message += f"📁 Total Files: {len(files)}\n"
-        message += f"💾 Total Size: {total_size / (1024 * 1024):.1f} MB\n"
-        message += f"👥 Total Users: {len(users)}\n"
-        message += f"✅ Approved Users: {approved_users}\n"
-        message += f"⏳ Pending Users: {pending_users}\n"
-        message += f"👑 Admin: Fyodor ✨"
+# route -> (handler, permission)
+CALLBACK_ROUTES = {
+    "main_menu": (main_menu_callback, PUBLIC),
+    "browse_files": (browse_files_callback, APPROVED),
+    "rename_file": (rename_file_callback, ADMIN),
+    "keep_original": (keep_original_callback, ADMIN),
+    "cancel_upload": (cancel_upload_callback, ADMIN),
+    "search_info": (search_info_callback, PUBLIC),
+    "search_page": (search_page_callback, APPROVED),
+    "my_stats": (my_stats_callback, PUBLIC),
+    "my_id": (my_id_callback, PUBLIC),
+    "admin_panel": (admin_panel_callback, ADMIN),
+    "upload_info": (upload_info_callback, ADMIN),
+    "manage_users": (manage_users_callback, ADMIN),
+    "pending_users": (pending_users_callback, ADMIN),
+    "delete_info": (delete_info_callback, ADMIN),
+    "admin_files": (admin_files_callback, ADMIN),
+    "admin_stats": (admin_stats_callback, ADMIN),
+    "show_help": (show_help_callback, PUBLIC),
+}
 
-        await query.edit_message_text(
-            message,
-            reply_markup=create_back_keyboard("admin_panel"),
-            parse_mode="Markdown"
-        )
 
-    # Handle help
-    elif data == "show_help":
-        if user_is_admin:
-            help_text = "❓ *Admin Help*\n\n"
-            help_text += "✨ *Commands:*\n"
-            help_text += "• `/add` - Upload file (reply to file)\n"
-            help_text += "• `/approve ID` - Approve user\n"
-            help_text += "• `/delete ID` - Delete file\n"
-            help_text += "• `/search` - Search files\n"
-            help_text += "• `/get ID` - Download file\n\n"
-            help_text += "💫 *Use beautiful buttons for easy navigation!*"
-        else:
-            help_text = "❓ *Help Center*\n\n"
-            help_text += "1. Get your ID from 'My ID' button 🆔\n"
-            help_text += "2. Send it to admin for approval ✨\n"
-            help_text += "3. Once approved, you can:\n"
-            help_text += "   • Browse files 📁\n"
-            help_text += "   • Download files ⬇️\n"
-            help_text += "   • Search files 🔍\n\n"
-            help_text += "✨ *Commands after approval:*\n"
-            help_text += "• `/get file_id` - Download\n"
-            help_text += "• `/search keyword` - Search"
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handle button clicks by routing them through CALLBACK_ROUTES"""
+    query = update.callback_query
+    route, _, payload = query.data.partition(":")
+    handler, permission = CALLBACK_ROUTES.get(route, (None, PUBLIC))
+    callback_route_counts[route if handler is not None else "unknown"] += 1
+    user_id = query.from_user.id
+
+    # Each query is answered exactly once - with an alert if access is denied
+    if permission == ADMIN and not is_admin(user_id):
+        await query.answer("❌ Admin only!", show_alert=True)
+        return
+    if permission == APPROVED and not is_admin(user_id) and not await check_user_approved(user_id):
+        await query.answer("❌ You need approval first!", show_alert=True)
+        return
+    await query.answer()
 
-        await query.edit_message_text(
-            help_text,
-            reply_markup=create_back_keyboard("main_menu"),
-            parse_mode="Markdown"
-        )
+    if handler is None:
+        logger.warning(f"Unknown callback data: {query.data}")
+        return
+    await handler(query, context, payload)
 
 
 # ========== MESSAGE HANDLER FOR RENAMING ==========
@@ -664,7 +2724,12 @@ async def handle_rename_message(update: Update, context: ContextTypes.DEFAULT_TY
     """Handle rename file name input"""
     user = update.effective_user
 
-    if user.id not in user_rename_context:
+    # Only the admin can start uploads, so skip the session lookup for everyone else
+    if not is_admin(user.id):
+        return
+
+    file_data = await call_session_store(upload_sessions.get, user.id)
+    if not file_data:
         return
 
     new_name = update.message.text.strip()
@@ -678,46 +2743,19 @@ async def handle_rename_message(update: Update, context: ContextTypes.DEFAULT_TY
         )
         return
 
-    file_data = user_rename_context[user.id]
-
     # Add extension if missing
     original_ext = os.path.splitext(file_data['original_name'])[1]
     if not new_name.lower().endswith(original_ext.lower()):
         new_name = new_name + original_ext
 
-    file_id = generate_file_id()
-    filepath = os.path.join(FILES_DIR, new_name)
-
-    try:
-        # Save the file
-        await file_data['file_obj'].download_to_drive(filepath)
-        file_size = os.path.getsize(filepath)
-
-        # Save to database with custom display name
-        save_file(file_id, new_name, file_data['original_name'], filepath, file_size, user.id)
-
-        size_mb = file_size / (1024 * 1024)
-
-        # Clear the context
-        del user_rename_context[user.id]
-
-        await update.message.reply_text(
-            f"✅ *File Uploaded Successfully!*\n\n"
-            f"📄 Name: {new_name}\n"
-            f"🆔 ID: `{file_id}`\n"
-            f"📦 Size: {size_mb:.1f} MB\n\n"
-            f"💫 Download with: `/get {file_id}`\n\n"
-            f"✨ *File renamed as requested*",
-            parse_mode="Markdown"
-        )
+    # Claim the upload so a second message can't save it twice
+    if not await call_session_store(upload_sessions.pop, user.id):
+        return
 
-    except Exception as e:
-        await update.message.reply_text(
-            f"❌ *Error saving file:*\n`{str(e)[:100]}`",
-            parse_mode="Markdown"
-        )
-        if user.id in user_rename_context:
-            del user_rename_context[user.id]
+    # Save the file in the background, reporting progress in a status message
+    status = await update.message.reply_text(f"⏬ Saving `{new_name}`... ✨", parse_mode="Markdown")
+    spawn_background_task(save_pending_upload(
+        context.bot, file_data, new_name, user.id, status.edit_text, "File renamed as requested"))
 
 
 # ========== TEXT COMMANDS ==========
@@ -725,7 +2763,7 @@ async def get_file_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Download file command"""
     user = update.effective_user
 
-    if not is_user_approved(user.id) and not is_admin(user.id):
+    if not is_admin(user.id) and not await check_user_approved(user.id):
         await update.message.reply_text(
             "❌ *You need approval to download files.*\n\n"
             f"Your ID: `{user.id}`\n"
@@ -744,7 +2782,7 @@ async def get_file_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     file_id = context.args[0]
-    file_data = get_file(file_id)
+    file_data = await run_storage(get_file, file_id)
 
     if not file_data:
         await update.message.reply_text(
@@ -754,10 +2792,30 @@ async def get_file_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    filepath = file_data[3]
-    display_name = file_data[1]
+    filepath = file_data['filepath']
+    display_name = file_data['display_name']
+    telegram_file_id = file_data['telegram_file_id']
+    # Blobs are stored without an extension, so go by the name users see
+    ext = (os.path.splitext(display_name)[1] or os.path.splitext(filepath)[1]).lower()
+    is_media = get_media_kind(ext) in ("audio", "video")
+    metadata = get_media_metadata(file_data) if is_media else {}
+
+    # Resend by Telegram reference when we have one - no bytes leave the server
+    if telegram_file_id:
+        try:
+            await update.message.reply_text(f"⏬ Downloading `{display_name}`... ✨")
+            await send_file_message(update.message, ext, telegram_file_id, display_name, metadata)
+            record_download(user.id, file_id)
+            transfer_stats["get_resends"] += 1
+            return
+        except BadRequest as e:
+            logger.info(f"Telegram rejected stored reference for {file_id} ({e}), re-uploading")
+            await run_storage(set_telegram_file_id, file_id, None)
+        except Exception as e:
+            await update.message.reply_text(f"❌ *Error:* `{str(e)[:100]}`")
+            return
 
-    if not os.path.exists(filepath):
+    if not await run_storage(os.path.exists, filepath):
         await update.message.reply_text(
             f"❌ *File missing on server:* `{display_name}`\n"
             "💫 Admin needs to re-upload this file.",
@@ -766,19 +2824,20 @@ async def get_file_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     try:
-        await update.message.reply_text(f"⏬ Downloading `{display_name}`... ✨")
+        if not telegram_file_id:
+            await update.message.reply_text(f"⏬ Downloading `{display_name}`... ✨")
 
-        with open(filepath, 'rb') as file:
-            ext = os.path.splitext(filepath)[1].lower()
+        file = await run_storage(read_file_bytes, filepath)
+        if is_media:
+            # Only uploads carry a thumbnail, so it is read here rather than with the row
+            metadata["thumbnail"] = await run_storage(get_media_thumbnail, file_id)
+        sent = await send_file_message(update.message, ext, file, display_name, metadata)
+        record_download(user.id, file_id)
+        transfer_stats["get_bytes_sent"] += len(file)
 
-            if ext in ['.jpg', '.jpeg', '.png', '.gif']:
-                await update.message.reply_photo(photo=file, caption=f"📸 {display_name}")
-            elif ext in ['.mp3', '.m4a', '.wav', '.flac']:
-                await update.message.reply_audio(audio=file, title=display_name, caption=f"🎵 {display_name}")
-            elif ext in ['.mp4', '.avi', '.mov', '.mkv']:
-                await update.message.reply_video(video=file, caption=f"🎬 {display_name}")
-            else:
-                await update.message.reply_document(document=file, filename=display_name)
+        sent_file_id = get_sent_file_id(sent)
+        if sent_file_id:
+            await run_storage(set_telegram_file_id, file_id, sent_file_id)
 
     except Exception as e:
         await update.message.reply_text(f"❌ *Error:* `{str(e)[:100]}`")
@@ -829,11 +2888,11 @@ async def add_file_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Store file data for renaming
-    user_rename_context[user.id] = {
-        'file_obj': await file_obj.get_file(),
+    await call_session_store(upload_sessions.put, user.id, {
+        'telegram_file_id': file_obj.file_id,
         'original_name': original_name,
         'message_id': update.message.message_id
-    }
+    })
 
     # Show rename options
     await update.message.reply_text(
@@ -866,7 +2925,7 @@ async def approve_user_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     try:
         user_id = int(context.args[0])
-        success = approve_user_in_db(user_id)
+        success = await run_storage(approve_user_in_db, user_id)
 
         if success:
             await update.message.reply_text(
@@ -904,20 +2963,21 @@ async def delete_file_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     file_id = context.args[0]
-    file_data = get_file(file_id)
+    file_data = await run_storage(get_file, file_id)
 
     if not file_data:
         await update.message.reply_text(f"❌ File `{file_id}` not found.")
         return
 
-    filepath = file_data[3]
-    display_name = file_data[1]
+    filepath = file_data['filepath']
+    display_name = file_data['display_name']
 
     try:
-        if os.path.exists(filepath):
-            os.remove(filepath)
+        success = await run_storage(delete_file_from_db, file_id)
 
-        success = delete_file_from_db(file_id)
+        # Only unlink once no other catalog entry shares the same bytes
+        if success:
+            await run_storage(release_file, filepath)
 
         if success:
             await update.message.reply_text(
@@ -937,7 +2997,7 @@ async def search_files_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Search files command"""
     user = update.effective_user
 
-    if not is_user_approved(user.id) and not is_admin(user.id):
+    if not is_admin(user.id) and not await check_user_approved(user.id):
         await update.message.reply_text(
             "❌ *You need approval to search files.*\n\n"
             f"Your ID: `{user.id}`",
@@ -957,12 +3017,7 @@ async def search_files_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     query = " ".join(context.args).lower()
-    files = get_all_files()
-
-    results = []
-    for file_id, display_name, original_name, file_size in files:
-        if query in display_name.lower() or query in original_name.lower():
-            results.append((file_id, display_name, file_size))
+    results, total = await run_storage(search_files, query, SEARCH_PAGE_SIZE)
 
     if not results:
         await update.message.reply_text(
@@ -971,22 +3026,726 @@ async def search_files_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         return
 
-    message = f"🔍 *Results for '{query}':* ✨\n\n"
-    for file_id, display_name, file_size in results[:10]:
-        size_mb = file_size / (1024 * 1024) if file_size else 0
-        display = display_name[:22] + "..." if len(display_name) > 25 else display_name
-        message += f"• `{file_id}`\n"
-        message += f"  📄 {display}\n"
-        message += f"  📦 {size_mb:.1f}MB\n"
-        message += f"  ⬇️ `/get {file_id}`\n\n"
+    # Remembered so the page buttons can re-run the search
+    context.user_data["search_query"] = query
+
+    message, keyboard = render_search_results(query, results, 0, total)
+    await update.message.reply_text(message, reply_markup=keyboard, parse_mode="Markdown")
+
+
+# ========== METRICS ==========
+# Collected in place by the code being measured (fixed histograms and
+# counters, no allocation per event) and only formatted when /metrics is
+# scraped. Gauges are read straight from the existing *_stats dicts.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+handler_latency = {}  # handler name -> Histogram, filled by timed_handler()
+storage_latency = {}  # function name -> Histogram, filled by run_storage()
+callback_route_counts = dict.fromkeys(list(CALLBACK_ROUTES) + ["unknown"], 0)
+
+# Counters for bytes moved by /get and /add
+transfer_stats = {
+    "get_bytes_sent": 0,
+    "get_resends": 0,
+    "add_bytes_received": 0
+}
+
+_metrics_server = None
+
+
+class Histogram:
+    """Latency histogram with fixed buckets, in the shape Prometheus expects"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name, labels):
+        """Format as cumulative bucket, sum and count lines"""
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {total}')
+        lines.append(f'{name}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{name}_count{{{labels}}} {total}')
+        return lines
+
+
+def timed_handler(name, handler):
+    """Wrap a handler so its latency is recorded under name (and traced if TRACE_UPDATES)"""
+    histogram = handler_latency.setdefault(name, Histogram())
+
+    @functools.wraps(handler)
+    async def timed(update, context):
+        trace = token = None
+        if TRACE_UPDATES:
+            trace = dict.fromkeys(TRACE_SPANS, 0.0)
+            token = _current_trace.set(trace)
+        started = time.perf_counter()
+        try:
+            return await handler(update, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            histogram.observe(elapsed)
+            if trace is not None:
+                _current_trace.reset(token)
+                if elapsed >= TRACE_SLOW_SECONDS:
+                    log_slow_update(name, update, elapsed, trace)
+    return timed
+
+
+def render_metrics():
+    """Build the /metrics page in the Prometheus text format"""
+    lines = []
+
+    def metric(name, kind, help_text, samples):
+        lines.append(f"# HELP file_bot_{name} {help_text}")
+        lines.append(f"# TYPE file_bot_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"file_bot_{name}{{{labels}}} {value}" if labels else f"file_bot_{name} {value}")
+
+    lines.append("# HELP file_bot_handler_seconds Time spent handling an update, by handler")
+    lines.append("# TYPE file_bot_handler_seconds histogram")
+    for name, histogram in list(handler_latency.items()):
+        lines.extend(histogram.render("file_bot_handler_seconds", f'handler="{name}"'))
+
+    lines.append("# HELP file_bot_storage_call_seconds Time spent in blocking database and disk calls")
+    lines.append("# TYPE file_bot_storage_call_seconds histogram")
+    for name, histogram in list(storage_latency.items()):
+        lines.extend(histogram.render("file_bot_storage_call_seconds", f'call="{name}"'))
+
+    metric("callback_taps_total", "counter", "Button taps, by callback route",
+           [(f'route="{route}"', count) for route, count in list(callback_route_counts.items())])
+    metric("transfer_bytes_total", "counter", "File bytes moved by /get and /add",
+           [('command="get",direction="sent"', transfer_stats["get_bytes_sent"]),
+            ('command="add",direction="received"', transfer_stats["add_bytes_received"])])
+    metric("get_resends_total", "counter", "Files sent by stored Telegram reference",
+           [("", transfer_stats["get_resends"])])
+
+    metric("storage_jobs", "gauge", "Storage jobs waiting for a slot or running",
+           [('state="waiting"', storage_stats["waiting"]), ('state="running"', storage_stats["in_flight"])])
+    metric("storage_jobs_total", "counter", "Storage jobs finished",
+           [('result="ok"', storage_stats["completed"] - storage_stats["failed"]),
+            ('result="failed"', storage_stats["failed"])])
+    metric("updates", "gauge", "Updates being handled or queued behind their chat",
+           [('state="running"', update_stats["running"]), ('state="waiting"', update_stats["waiting"])])
+    metric("updates_total", "counter", "Updates handled", [("", update_stats["processed"])])
+    metric("updates_peak_waiting", "gauge", "Most updates queued behind their chat at once since start",
+           [("", update_stats["peak_waiting"])])
+    metric("outbound_requests", "gauge", "Bot API requests waiting for the rate limiter",
+           [('lane="high"', outbound_stats["waiting_high"]), ('lane="low"', outbound_stats["waiting_low"])])
+    metric("outbound_requests_total", "counter", "Bot API requests sent", [("", outbound_stats["sent"])])
+    metric("outbound_flood_waits_total", "counter", "429 flood-wait responses", [("", outbound_stats["flood_waits"])])
+    metric("outbound_retries_total", "counter", "Bot API requests retried after a flood-wait",
+           [("", outbound_stats["retries"])])
+    lines.append("# HELP file_bot_outbound_lag_seconds Time a Bot API request waited for the rate limiter, by lane")
+    lines.append("# TYPE file_bot_outbound_lag_seconds histogram")
+    for lane, histogram in outbound_lag.items():
+        lines.extend(histogram.render("file_bot_outbound_lag_seconds", f'lane="{lane}"'))
+    metric("outbound_max_lag_seconds", "gauge", "Longest wait for the rate limiter since start, by lane",
+           [('lane="high"', outbound_stats["max_lag_high"]), ('lane="low"', outbound_stats["max_lag_low"])])
+
+    metric("cache_hit_ratio", "gauge", "Share of cache lookups answered from memory",
+           [('cache="render"', cache_hit_rate(render_cache_stats)),
+            ('cache="approval"', cache_hit_rate(approval_cache_stats))])
+    metric("cache_lookups_total", "counter", "Cache lookups",
+           [(f'cache="{cache}",result="{result}"', stats[result])
+            for cache, stats in (("render", render_cache_stats), ("approval", approval_cache_stats))
+            for result in ("hits", "misses")])
+
+    # Everything here is read from memory - this runs on the HTTP server's threads, which must not open
+    # database connections (get_db() would keep one per scrape)
+    metric("upload_sessions", "gauge", "Uploads waiting for Rename or Keep Original",
+           [("", upload_sessions.count())])
+    with _pending_downloads_lock:
+        pending_downloads = len(_pending_downloads)
+    metric("pending_download_counts", "gauge", "User/file download counters not yet written to the database",
+           [("", pending_downloads)])
+    metric("watcher_events_total", "counter", "File events seen in FILES_DIR", [("", watcher_stats["events"])])
+    metric("media_metadata_files_total", "counter", "Files handled by media metadata extraction",
+           [(f'result="{result}"', count) for result, count in media_stats.items()])
+
+    lines.append("")
+    return "\n".join(lines)
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    """Answers GET /metrics"""
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render_metrics().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # Scrapes every few seconds would drown the log
+
+
+def start_metrics_server():
+    """Serve /metrics on a background thread"""
+    global _metrics_server
+    _metrics_server = ThreadingHTTPServer((METRICS_LISTEN, METRICS_PORT), MetricsRequestHandler)
+    _metrics_server.daemon_threads = True
+    threading.Thread(target=_metrics_server.serve_forever, name="metrics", daemon=True).start()
+    logger.info(f"Metrics on http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+
+
+def stop_metrics_server():
+    """Stop serving /metrics"""
+    global _metrics_server
+    if _metrics_server is not None:
+        _metrics_server.shutdown()
+        _metrics_server.server_close()
+        _metrics_server = None
+
+
+# ========== TRACING ==========
+# With TRACE_UPDATES on, timed_handler() gives each update a dict of span
+# totals through a context variable. run_storage() adds database, disk and
+# render time to it and the rate limiter adds Telegram API time, so a slow
+# update can be logged with where its time went.
+TRACE_SPANS = ("db", "fs", "render", "api", "api_wait")
+
+# run_storage() calls that work on files rather than the database
+FS_CALLS = frozenset({
+    "open", "exists", "BufferedReader.read", "BufferedReader.close", "read_file_bytes", "remove_file_if_exists",
+    "open_temp_upload", "write_upload_chunk", "finish_temp_upload", "discard_temp_upload",
+    "store_upload", "release_file", "scan_files_dir", "next_import_batch",
+})
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_profiling = False
+
+
+def get_storage_span(name):
+    """Get the span a run_storage() call counts towards"""
+    if name.startswith("render_"):
+        return "render"
+    return "fs" if name in FS_CALLS else "db"
+
+
+def describe_update(update):
+    """Short description of an update for the slow update log"""
+    query = getattr(update, "callback_query", None)
+    if query is not None:
+        return f"button {query.data!r}"
+    message = getattr(update, "message", None)
+    if message is not None and message.text:
+        return f"message {message.text[:40]!r}"
+    return "update"
+
+
+def log_slow_update(name, update, elapsed, trace):
+    """Log an update that took longer than TRACE_SLOW_SECONDS with its span breakdown"""
+    other = max(0.0, elapsed - sum(trace.values()))
+    spans = ", ".join(f"{span} {seconds * 1000:.0f}ms" for span, seconds in trace.items())
+    user = getattr(update, "effective_user", None)
+    logger.warning(
+        f"Slow update: {name} {describe_update(update)} from {getattr(user, 'id', '?')} took "
+        f"{elapsed * 1000:.0f}ms ({spans}, other {other * 1000:.0f}ms)")
+
+
+def summarize_profile(profiler):
+    """Format the top entries of a profile and serialize the whole profile for pstats
+
+    Returns (summary_text, pstats_file_bytes).
+    """
+    stats = pstats.Stats(profiler, stream=io.StringIO())
+    fd, path = tempfile.mkstemp(suffix=".pstats")
+    os.close(fd)
+    try:
+        stats.dump_stats(path)
+        with open(path, 'rb') as f:
+            data = f.read()
+    finally:
+        os.remove(path)
+
+    stream = io.StringIO()
+    stats.stream = stream
+    stats.strip_dirs().sort_stats("cumulative").print_stats(PROFILE_TOP)
+    return stream.getvalue(), data
+
+
+async def profile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Profile the event loop for a few seconds and send the results"""
+    global _profiling
+    user = update.effective_user
+
+    if not is_admin(user.id):
+        await update.message.reply_text("❌ Admin only command.")
+        return
+
+    if _profiling:
+        await update.message.reply_text("⏳ A profile is already being captured.")
+        return
+
+    try:
+        seconds = int(context.args[0]) if context.args else PROFILE_SECONDS
+    except ValueError:
+        seconds = PROFILE_SECONDS
+    seconds = min(max(1, seconds), PROFILE_MAX_SECONDS)
 
-    if len(results) > 10:
-        message += f"✨ ... and {len(results) - 10} more results\n"
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError as e:
+        # Another profiler (or debugger) already owns the hook
+        await update.message.reply_text(f"❌ *Cannot profile:* `{str(e)[:100]}`", parse_mode="Markdown")
+        return
+
+    _profiling = True
+    # Captured in the background - waiting here would hold the admin's chat, so their own taps (the usual way to
+    # reproduce a slow screen) would queue behind the profile instead of showing up in it
+    spawn_background_task(capture_profile(profiler, seconds, update.message))
 
-    await update.message.reply_text(message, parse_mode="Markdown")
+
+async def capture_profile(profiler, seconds, message):
+    """Let an enabled profiler run for a while, then reply to message with its summary and .pstats file"""
+    global _profiling
+    try:
+        await message.reply_text(f"🔬 *Profiling for {seconds}s...* ✨", parse_mode="Markdown")
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+        _profiling = False
+
+    summary, data = await run_storage(summarize_profile, profiler)
+    # Only the event loop thread is profiled - storage calls show up as waits on run_in_executor
+    await message.reply_text(summary[:MESSAGE_CHAR_LIMIT - 100] or "Nothing ran while profiling.")
+    await message.reply_document(
+        document=data,
+        filename=f"profile_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.pstats",
+        caption="📊 Open with: python -m pstats <file>"
+    )
+
+
+# ========== BACKGROUND TASKS ==========
+_background_tasks = []
+
+
+def spawn_background_task(coroutine):
+    """Run a handler's long job (an upload, an import) without holding up its chat"""
+    _background_tasks[:] = [task for task in _background_tasks if not task.done()]
+    task = asyncio.create_task(coroutine)
+    task.add_done_callback(log_background_failure)
+    _background_tasks.append(task)
+    return task
+
+
+def log_background_failure(task):
+    """Log an exception that escaped a spawned task - nobody awaits it to see it"""
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("Background task failed", exc_info=task.exception())
+
+
+async def start_background_tasks(application):
+    """Start background jobs once the bot is initialized"""
+    _background_tasks.append(asyncio.create_task(download_flush_loop()))
+    _background_tasks.append(asyncio.create_task(upload_session_sweep_loop()))
+    if WATCH_FILES:
+        _background_tasks.extend(file_watcher.start())
+    if can_extract_media():
+        _background_tasks.append(asyncio.create_task(media_metadata_loop()))
+    if METRICS_PORT:
+        start_metrics_server()
+
+
+async def stop_background_tasks(application):
+    """Stop background jobs and write out anything still batched"""
+    stop_metrics_server()
+    file_watcher.stop()
+    for task in _background_tasks:
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
+    _background_tasks.clear()
+    shutdown_media_executor()
+    if WATCH_FILES:
+        await file_watcher.apply_pending()
+    await run_storage(flush_downloads)
+    await close_http_client()
+
+
+# ========== UPDATE SCHEDULING ==========
+# Counters for the update scheduler
+update_stats = {
+    "processed": 0,
+    "running": 0,
+    "waiting": 0,
+    "peak_waiting": 0,
+    "busy_chats": 0
+}
+
+
+def get_update_chat_key(update):
+    """Get the chat an update belongs to, or None if it has none"""
+    chat = getattr(update, "effective_chat", None)
+    if chat is not None:
+        return chat.id
+    user = getattr(update, "effective_user", None)
+    return user.id if user is not None else None
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Processes updates concurrently across chats but in order within a chat
+
+    Each chat has an asyncio.Lock taken before a worker slot, so a chat with
+    a backlog queues behind itself instead of tying up slots other chats
+    could use. asyncio locks wake waiters first-come first-served, and PTB
+    starts update tasks in arrival order, so a chat's updates run strictly
+    in the order they arrived - the rename flow relies on this.
+
+    PTB's own semaphore is taken before do_process_update(), ahead of the
+    chat lock, so it is sized to `max_backlog` and only bounds how many
+    updates are accepted; `max_concurrent_updates` worker slots are a
+    second semaphore taken once the chat lock is held.
+    """
+
+    def __init__(self, max_concurrent_updates, max_backlog):
+        super().__init__(max(max_backlog, max_concurrent_updates))
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._chat_locks = {}
+        self._chat_pending = {}
+
+    async def do_process_update(self, update, coroutine):
+        key = get_update_chat_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+
+        lock = self._chat_locks.get(key)
+        if lock is None:
+            lock = self._chat_locks[key] = asyncio.Lock()
+            update_stats["busy_chats"] += 1
+        self._chat_pending[key] = self._chat_pending.get(key, 0) + 1
+
+        update_stats["waiting"] += 1
+        update_stats["peak_waiting"] = max(update_stats["peak_waiting"], update_stats["waiting"])
+        waiting = True
+        try:
+            async with lock:
+                update_stats["waiting"] -= 1
+                waiting = False
+                await self._run(coroutine)
+        finally:
+            if waiting:
+                update_stats["waiting"] -= 1
+            self._chat_pending[key] -= 1
+            if not self._chat_pending[key]:
+                # Last queued update for this chat - drop its lock so idle chats cost nothing
+                del self._chat_pending[key]
+                del self._chat_locks[key]
+                update_stats["busy_chats"] -= 1
+
+    async def _run(self, coroutine):
+        async with self._slots:
+            update_stats["running"] += 1
+            try:
+                await coroutine
+            finally:
+                update_stats["running"] -= 1
+                update_stats["processed"] += 1
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+
+# ========== OUTBOUND RATE LIMITING ==========
+# Counters for outgoing Bot API requests. Lag is the time a request spent
+# waiting for its rate limits before being sent.
+outbound_stats = {
+    "sent": 0,
+    "retries": 0,
+    "flood_waits": 0,
+    "waiting_high": 0,
+    "waiting_low": 0,
+    "max_lag_high": 0.0,
+    "max_lag_low": 0.0
+}
+outbound_lag = {"high": Histogram(), "low": Histogram()}
+
+# Media uploads go in the low lane so menu edits and replies overtake them
+LOW_PRIORITY_ENDPOINTS = {
+    "sendDocument", "sendVideo", "sendAudio", "sendPhoto", "sendAnimation", "sendVoice", "sendMediaGroup"
+}
+# Only requests that post to a chat count towards Telegram's flood limits
+RATE_LIMITED_PREFIXES = ("send", "edit", "copy", "forward")
+
+
+class TokenBucket:
+    """Allows `rate` events per second with bursts of up to `capacity`"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now):
+        """Seconds until a token is available"""
+        self.refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class PriorityRateLimiter(BaseRateLimiter):
+    """Throttles outgoing requests with global, per-chat and per-group token buckets
+
+    Each chat has two FIFO queues: high (replies, menu edits) and low
+    (media uploads). One dispatcher task hands out send slots as the
+    buckets allow - within a chat requests go out in the order they were
+    made, high before low, and across chats high-lane requests are served
+    first while low-lane ones leave the last global tokens free for them.
+    A 429 RetryAfter pauses all sends for the time Telegram asks and the
+    request is retried, at the head of its queue, up to
+    OUTBOUND_MAX_RETRIES times. Pass rate_limit_args={"priority": "high"}
+    or "low" to a Bot method to override the lane.
+    """
+
+    def __init__(self):
+        self._global = TokenBucket(OUTBOUND_GLOBAL_RATE, OUTBOUND_GLOBAL_RATE)
+        self._chats = {}
+        self._queues = OrderedDict()  # chat_id -> {"high": deque, "low": deque} of waiting futures
+        self._wakeup = asyncio.Event()
+        self._dispatcher = None
+        self._paused_until = 0.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Group and channel ids are negative
+            if isinstance(chat_id, int) and chat_id < 0:
+                bucket = TokenBucket(OUTBOUND_GROUP_RATE, 1)
+            else:
+                bucket = TokenBucket(OUTBOUND_CHAT_RATE, OUTBOUND_CHAT_BURST)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > 10000:
+                self._forget_idle_chats()
+        return bucket
+
+    def _forget_idle_chats(self):
+        now = time.monotonic()
+        for chat_id, bucket in list(self._chats.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._chats[chat_id]
+
+    async def _acquire(self, lane, chat_id, retry=False):
+        """Queue behind earlier requests to the chat and wait for the dispatcher to grant a send"""
+        queues = self._queues.get(chat_id)
+        if queues is None:
+            queues = self._queues[chat_id] = {"high": deque(), "low": deque()}
+        granted = asyncio.get_running_loop().create_future()
+        if retry:
+            queues[lane].appendleft(granted)
+        else:
+            queues[lane].append(granted)
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wakeup.set()
+        await granted
+
+    def _grant_next(self, now):
+        """Grant the next send the buckets allow
+
+        Returns 0 if one was granted, otherwise the seconds until one might
+        be (None if nothing is waiting).
+        """
+        for chat_id in [chat_id for chat_id, queues in self._queues.items()
+                        if not queues["high"] and not queues["low"]]:
+            del self._queues[chat_id]
+
+        high_waiting = any(queues["high"] for queues in self._queues.values())
+        soonest = None
+        for lane in ("high", "low"):
+            if lane == "low" and high_waiting and self._global.tokens < 2:
+                # Keep the last global tokens for high-lane requests waiting on their chats
+                reserve_wait = (2 - self._global.tokens) / self._global.rate
+                return reserve_wait if soonest is None else min(soonest, reserve_wait)
+            for chat_id, queues in self._queues.items():
+                waiters = queues[lane]
+                while waiters and waiters[0].done():
+                    waiters.popleft()  # Cancelled while queued
+                if not waiters:
+                    continue
+                # A chat's high lane was served in the first pass, so reaching its low lane means it is empty
+                # or its bucket is dry - either way the low request has to wait for the bucket too
+                bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+                delay = bucket.delay(now) if bucket is not None else 0.0
+                if delay > 0:
+                    soonest = delay if soonest is None else min(soonest, delay)
+                    continue
+                waiters.popleft().set_result(None)
+                self._global.take()
+                if bucket is not None:
+                    bucket.take()
+                self._queues.move_to_end(chat_id)  # Round-robin between chats
+                return 0
+        return soonest
+
+    async def _dispatch(self):
+        """Hand out send slots in queue order as the buckets allow"""
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            wait = max(self._paused_until - now, self._global.delay(now))
+            if wait <= 0:
+                wait = self._grant_next(now)
+                if wait == 0:
+                    continue
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        limited = endpoint.startswith(RATE_LIMITED_PREFIXES)
+        priority = (rate_limit_args or {}).get("priority")
+        lane = priority or ("low" if endpoint in LOW_PRIORITY_ENDPOINTS else "high")
+        chat_id = data.get("chat_id")
+        trace = _current_trace.get()
+
+        for attempt in range(OUTBOUND_MAX_RETRIES + 1):
+            if limited:
+                queued = time.monotonic()
+                outbound_stats[f"waiting_{lane}"] += 1
+                try:
+                    await self._acquire(lane, chat_id, retry=attempt > 0)
+                finally:
+                    outbound_stats[f"waiting_{lane}"] -= 1
+                lag = time.monotonic() - queued
+                outbound_lag[lane].observe(lag)
+                outbound_stats[f"max_lag_{lane}"] = max(outbound_stats[f"max_lag_{lane}"], lag)
+                if trace is not None:
+                    trace["api_wait"] += lag
+
+            started = time.perf_counter()
+            try:
+                result = await callback(*args, **kwargs)
+                outbound_stats["sent"] += 1
+                return result
+            except RetryAfter as e:
+                if attempt == OUTBOUND_MAX_RETRIES:
+                    raise
+                retry_after = e.retry_after
+                if hasattr(retry_after, "total_seconds"):
+                    retry_after = retry_after.total_seconds()
+                outbound_stats["flood_waits"] += 1
+                outbound_stats["retries"] += 1
+                logger.warning(f"Flood limit on {endpoint}, pausing sends for {retry_after}s")
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                if not limited:
+                    await asyncio.sleep(retry_after)
+            finally:
+                if trace is not None:
+                    trace["api"] += time.perf_counter() - started
+
+
+# ========== UPDATE DELIVERY ==========
+def get_allowed_updates(app):
+    """Work out which update types the registered handlers actually use"""
+    update_types = set()
+    for handlers in app.handlers.values():
+        for handler in handlers:
+            if isinstance(handler, CallbackQueryHandler):
+                update_types.add("callback_query")
+            elif isinstance(handler, (CommandHandler, MessageHandler)):
+                update_types.add("message")
+    return sorted(update_types)
+
+
+def run_bot(app):
+    """Receive updates by long polling or through the embedded webhook server"""
+    allowed_updates = get_allowed_updates(app)
+    print(f"📨 Update types: {', '.join(allowed_updates)}")
+
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise ValueError("WEBHOOK_URL must be set when BOT_MODE is 'webhook'")
+        print(f"🌐 Webhook: {WEBHOOK_URL} -> {WEBHOOK_LISTEN}:{WEBHOOK_PORT}/{WEBHOOK_PATH}")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=WEBHOOK_URL,
+            # Requests without this X-Telegram-Bot-Api-Secret-Token are rejected
+            secret_token=WEBHOOK_SECRET or secrets.token_urlsafe(32),
+            allowed_updates=allowed_updates,
+            drop_pending_updates=False
+        )
+    else:
+        app.run_polling(allowed_updates=allowed_updates)
+
+
+async def import_files_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Import files already sitting in the files folder"""
+    user = update.effective_user
+
+    if not is_admin(user.id):
+        await update.message.reply_text("❌ Admin only command.")
+        return
+
+    global _import_running
+    if _import_running:
+        await update.message.reply_text("⏳ An import is already running.")
+        return
+    _import_running = True
+
+    status = await update.message.reply_text("📥 *Importing Files...*", parse_mode="Markdown")
+    spawn_background_task(run_import(status.edit_text, user.id))
 
 
 # ========== MAIN ==========
+def import_cli():
+    """Import FILES_DIR from the command line: python local_file_bot.py import"""
+    init_database()
+    print(f"📥 Importing {os.path.abspath(FILES_DIR)}...")
+    started = time.monotonic()
+    scanned = added = updated = 0
+    seen = set()
+    unreadable = []
+    for batch in iter_import_batches(unreadable=unreadable):
+        batch_added, batch_updated = import_batch(batch, ADMIN_ID)
+        seen.update(filepath for filepath, _, _ in batch)
+        scanned += len(batch)
+        added += batch_added
+        updated += batch_updated
+        print(f"   {scanned} scanned, {added} added, {updated} updated")
+    removed = remove_missing_files(seen, unreadable)
+    print(format_import_progress(scanned, added, updated, time.monotonic() - started, done=True,
+                                 removed=removed).replace("*", ""))
+    close_database()
+
+
 def main():
     """Start the bot"""
     # Initialize database
@@ -1000,24 +3759,37 @@ def main():
     print("✅ Feature: File Renaming during upload")
     print("✅ Feature: Beautiful glass-style UI")
     print("✅ Feature: User approval system")
+    print("✅ Feature: Bulk import (/import or 'python local_file_bot.py import')")
     print("=" * 60)
 
     # Create bot
-    app = Application.builder().token(BOT_TOKEN).build()
+    app = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(TELEGRAM_API_URL)
+        .base_file_url(TELEGRAM_FILE_URL)
+        .concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_BACKLOG))
+        .rate_limiter(PriorityRateLimiter())
+        .post_init(start_background_tasks)
+        .post_shutdown(stop_background_tasks)
+        .build()
+    )
 
     # Add command handlers
-    app.add_handler(CommandHandler("start", start))
-    app.add_handler(CommandHandler("get", get_file_cmd))
-    app.add_handler(CommandHandler("add", add_file_cmd))
-    app.add_handler(CommandHandler("approve", approve_user_cmd))
-    app.add_handler(CommandHandler("delete", delete_file_cmd))
-    app.add_handler(CommandHandler("search", search_files_cmd))
+    app.add_handler(CommandHandler("start", timed_handler("start", start)))
+    app.add_handler(CommandHandler("get", timed_handler("get", get_file_cmd)))
+    app.add_handler(CommandHandler("add", timed_handler("add", add_file_cmd)))
+    app.add_handler(CommandHandler("approve", timed_handler("approve", approve_user_cmd)))
+    app.add_handler(CommandHandler("delete", timed_handler("delete", delete_file_cmd)))
+    app.add_handler(CommandHandler("search", timed_handler("search", search_files_cmd)))
+    app.add_handler(CommandHandler("import", timed_handler("import", import_files_cmd)))
+    app.add_handler(CommandHandler("profile", timed_handler("profile", profile_cmd)))
 
     # Add callback handler for buttons
-    app.add_handler(CallbackQueryHandler(handle_callback))
+    app.add_handler(CallbackQueryHandler(timed_handler("callback", handle_callback)))
 
     # Add message handler for rename input
-    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_rename_message))
+    app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler("rename", handle_rename_message)))
 
     print("🔄 Starting bot...")
     print("📱 Send /start to your bot")
@@ -1025,13 +3797,19 @@ def main():
     print("=" * 60)
 
     try:
-        app.run_polling(allowed_updates=Update.ALL_TYPES)
+        run_bot(app)
     except KeyboardInterrupt:
         print("\n👋 Bot stopped by user")
     except Exception as e:
         print(f"\n❌ Error: {e}")
+    finally:
+        shutdown_storage()
+        close_database()
 
 
 if __name__ == '__main__':
 
-    main()
+    if sys.argv[1:2] == ["import"]:
+        import_cli()
+    else:
+        main()